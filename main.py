@@ -1,4 +1,4 @@
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, HTTPException, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
 from typing import Dict, List
 from uuid import uuid4
@@ -6,7 +6,7 @@ from fastapi.middleware.cors import CORSMiddleware
 import subprocess
 import os
 import platform
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 import shutil
 from typing import Optional
 import uuid
@@ -16,8 +16,45 @@ import jinja2
 from ipaddress import ip_address, IPv4Address
 import logging
 import socket
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import fcntl
+import ipaddress
+import json
+import signal
+import sqlite3
+from contextlib import contextmanager, asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from collections import deque, OrderedDict
+from array import array
+import bisect
+import math
+import gzip
+import re
 
-app = FastAPI()
+try:
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa, ec
+except ImportError:  # Sin cryptography se siguen firmando los certificados con openssl
+    x509 = None
+
+
+# Arranque y parada en un solo sitio; los pasos (bootstrap y shutdown) están al final del fichero
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await bootstrap()
+    try:
+        yield
+    finally:
+        await shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS Middleware
 app.add_middleware(
@@ -28,20 +65,1854 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Configuración de logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Configuración de logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Directorio de configuraciones OpenVPN
+OPEN_VPN_DIR = os.environ.get("OPEN_VPN_DIR", "/tmp/openvpn_rooms")
+# Estado de usuarios y salas: "sqlite" (compartido entre workers) o "memory" (diccionarios)
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "sqlite")
+STATE_DB = os.environ.get("STATE_DB", os.path.join(OPEN_VPN_DIR, "state.db"))
+# Salas sin proceso (y reservas de arranque sin PID) más antiguas que esto se consideran
+# restos de un arranque fallido
+RECONCILE_GRACE = float(os.environ.get("RECONCILE_GRACE", "120"))
+# Supervisión de los procesos openvpn: reinicios con backoff, parada y logs rotativos
+SUPERVISOR_MAX_RESTARTS = int(os.environ.get("SUPERVISOR_MAX_RESTARTS", "5"))
+SUPERVISOR_BACKOFF = float(os.environ.get("SUPERVISOR_BACKOFF", "1"))
+SUPERVISOR_BACKOFF_MAX = float(os.environ.get("SUPERVISOR_BACKOFF_MAX", "60"))
+SUPERVISOR_STABLE_SECONDS = float(os.environ.get("SUPERVISOR_STABLE_SECONDS", "60"))
+STOP_TIMEOUT = float(os.environ.get("STOP_TIMEOUT", "10"))
+PROCESS_LOG_MAX_BYTES = int(os.environ.get("PROCESS_LOG_MAX_BYTES", str(1024 * 1024)))
+PROCESS_LOG_BACKUPS = int(os.environ.get("PROCESS_LOG_BACKUPS", "3"))
+# IP que se anuncia a los clientes; si no se da, se resuelve al arrancar (fuera del import)
+SERVER_IP = os.environ.get("SERVER_IP")
+SERVER_IP_RESOLVE_TIMEOUT = float(os.environ.get("SERVER_IP_RESOLVE_TIMEOUT", "5"))
+# Clave tls-auth opcional que se incrusta en las configuraciones de cliente
+TLS_AUTH_FILE = os.environ.get("TLS_AUTH_FILE", "ta.key")
+# Pool de parámetros DH pre-generados (sobrevive a reinicios porque vive en disco)
+DH_POOL_DIR = os.environ.get("DH_POOL_DIR", os.path.join(OPEN_VPN_DIR, "dh_pool"))
+DH_POOL_SIZE = int(os.environ.get("DH_POOL_SIZE", "4"))
+DH_BITS = int(os.environ.get("DH_BITS", "2048"))
+# Hilos para E/S de ficheros y trabajo bloqueante, fuera del event loop
+WORKER_THREADS = int(os.environ.get("WORKER_THREADS", "8"))
+# Tiempo que se conservan los trabajos terminados y espera máxima del long-poll
+JOB_TTL = int(os.environ.get("JOB_TTL", "3600"))
+JOB_MAX_WAIT = float(os.environ.get("JOB_MAX_WAIT", "30"))
+# Emisión de certificados de cliente en proceso (requiere cryptography)
+CA_KEY_FILE = os.environ.get("CA_KEY_FILE", "ca.key")
+CA_CERT_FILE = os.environ.get("CA_CERT_FILE", "ca.crt")
+CLIENT_KEY_TYPE = os.environ.get("CLIENT_KEY_TYPE", "rsa")  # rsa | ecdsa
+CLIENT_KEY_BITS = int(os.environ.get("CLIENT_KEY_BITS", "2048"))
+CLIENT_KEY_POOL_SIZE = int(os.environ.get("CLIENT_KEY_POOL_SIZE", "16"))
+# /ready espera a tener al menos estos parámetros DH y claves de cliente en los pools
+READY_DH_POOL_MIN = int(os.environ.get("READY_DH_POOL_MIN", "1"))
+READY_KEY_POOL_MIN = int(os.environ.get("READY_KEY_POOL_MIN", str(CLIENT_KEY_POOL_SIZE)))
+CLIENT_CERT_DAYS = int(os.environ.get("CLIENT_CERT_DAYS", "3650"))
+SERIAL_BLOCK = int(os.environ.get("SERIAL_BLOCK", "256"))
+# Modo de red: "per-room" (un openvpn por sala) o "multiplexed" (servidores compartidos)
+VPN_MODE = os.environ.get("VPN_MODE", "per-room")
+MUX_SERVERS = int(os.environ.get("MUX_SERVERS", str(os.cpu_count() or 1)))
+MUX_BASE_PORT = int(os.environ.get("MUX_BASE_PORT", "1194"))
+MUX_PROTO = os.environ.get("MUX_PROTO", "udp")
+# Cada servidor recibe una red MUX_SERVER_PREFIX de MUX_NETWORK y cada sala una ROOM_SUBNET_PREFIX
+MUX_NETWORK = os.environ.get("MUX_NETWORK", "10.8.0.0/13")
+MUX_SERVER_PREFIX = int(os.environ.get("MUX_SERVER_PREFIX", "16"))
+ROOM_SUBNET_PREFIX = int(os.environ.get("ROOM_SUBNET_PREFIX", "24"))
+# Puertos y subredes que se reparten entre las salas en modo per-room
+VPN_PROTO = os.environ.get("VPN_PROTO", "udp")
+VPN_PORT_RANGE = os.environ.get("VPN_PORT_RANGE", "1194-2193")
+VPN_SUBNET_POOL = os.environ.get("VPN_SUBNET_POOL", "10.8.0.0/16")
+# Aislar las salas con reglas iptables (requiere privilegios)
+MUX_FIREWALL = os.environ.get("MUX_FIREWALL", "1") == "1"
+SERVER_CERT_FILE = os.environ.get("SERVER_CERT_FILE", "server.crt")
+SERVER_KEY_FILE = os.environ.get("SERVER_KEY_FILE", "server.key")
+# Segundos que se reutiliza la lista de clientes leída de la interfaz de gestión
+MANAGEMENT_SCRAPE_TTL = float(os.environ.get("MANAGEMENT_SCRAPE_TTL", "10"))
+# Control de admisión (por worker): trabajos simultáneos por clase y cola de espera acotada
+DH_CONCURRENCY = int(os.environ.get("DH_CONCURRENCY", "2"))
+CRYPTO_CONCURRENCY = int(os.environ.get("CRYPTO_CONCURRENCY", str(os.cpu_count() or 2)))
+SPAWN_CONCURRENCY = int(os.environ.get("SPAWN_CONCURRENCY", "4"))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "32"))
+ADMISSION_USER_QUEUE_SIZE = int(os.environ.get("ADMISSION_USER_QUEUE_SIZE", "4"))
+# Flujos de eventos de salas: historial para reanudar, cola por suscriptor, ventana de agrupado
+EVENT_HISTORY_SIZE = int(os.environ.get("EVENT_HISTORY_SIZE", "1024"))
+EVENT_QUEUE_SIZE = int(os.environ.get("EVENT_QUEUE_SIZE", "256"))
+EVENT_COALESCE_WINDOW = float(os.environ.get("EVENT_COALESCE_WINDOW", "0.05"))
+EVENT_KEEPALIVE = float(os.environ.get("EVENT_KEEPALIVE", "15"))
+# openvpn de cada sala arranca con el primer invitado y se para/expira tras estar inactivo (0 = nunca)
+LAZY_SERVER_START = os.environ.get("LAZY_SERVER_START", "1") == "1"
+SERVER_IDLE_TIMEOUT = float(os.environ.get("SERVER_IDLE_TIMEOUT", "600"))
+ROOM_IDLE_TIMEOUT = float(os.environ.get("ROOM_IDLE_TIMEOUT", "86400"))
+REAPER_INTERVAL = float(os.environ.get("REAPER_INTERVAL", "30"))
+# Limpieza incremental de directorios de salas y usuarios que ya no existen
+GC_INTERVAL = float(os.environ.get("GC_INTERVAL", "5"))
+GC_BATCH_SIZE = int(os.environ.get("GC_BATCH_SIZE", "100"))
+GC_GRACE = float(os.environ.get("GC_GRACE", "600"))
+
+
+# Modelo para los templates
+template_loader = jinja2.FileSystemLoader(searchpath="./templates")
+template_env = jinja2.Environment(loader=template_loader)
+# Plantillas compiladas al arrancar; get_template no vuelve a mirar el disco para ellas
+compiled_templates = {}
+
+
+def get_template(name: str) -> jinja2.Template:
+    template = compiled_templates.get(name)
+    if template is None:
+        template = compiled_templates[name] = template_env.get_template(name)
+    return template
+
+
+executor = ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="vpn-worker")
+
+
+# Ejecuta una función bloqueante en el ejecutor acotado sin parar el event loop
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+# Ejecuta un comando externo como subproceso asyncio y falla si no termina bien
+async def run_command(*args, cwd=None):
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, list(args), stdout, stderr)
+    return stdout
+
+
+def write_file(path: str, content: str):
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def read_file(path: str) -> str:
+    with open(path, "r") as f:
+        return f.read()
+
+
+# Métricas en formato de texto de Prometheus (por worker)
+metrics_registry = []
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{format_labels(dict(zip(self.labels, key)))} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            series["buckets"][bisect.bisect_left(self.buckets, value)] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in self._series.items():
+                labels = dict(zip(self.labels, key))
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), series["buckets"]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': le})} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {series['sum']}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {series['count']}")
+        return lines
+
+
+def render_gauge(name: str, help_text: str, samples) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    for labels, value in samples:
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    return lines
+
+
+stage_duration = Histogram("vpn_stage_duration_seconds", "Duración de cada etapa de creación de salas y altas de clientes", ("stage",))
+request_duration = Histogram("http_request_duration_seconds", "Latencia de las peticiones HTTP por ruta", ("method", "route", "status"))
+failures_total = Counter("vpn_failures_total", "Operaciones fallidas", ("operation",))
+rooms_created_total = Counter("vpn_rooms_created_total", "Salas creadas")
+joins_total = Counter("vpn_joins_total", "Altas de participantes en salas")
+leaves_total = Counter("vpn_leaves_total", "Bajas de participantes en salas")
+event_loop_lag = Histogram(
+    "vpn_event_loop_lag_seconds", "Retraso del event loop al despertar de un temporizador",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+EVENT_LOOP_LAG_INTERVAL = 0.1
+
+
+# Mide cuánto tarda el event loop en despertar de un sleep: si algo lo bloquea, el retraso crece
+async def monitor_event_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        event_loop_lag.observe(max(loop.time() - start - EVENT_LOOP_LAG_INTERVAL, 0.0))
+
+
+background_tasks = set()
+
+
+async def start_event_loop_monitor():
+    task = asyncio.create_task(monitor_event_loop_lag())
+    background_tasks.add(task)
+
+
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Se agrupa por plantilla de ruta (/rooms/{room_id}) para no crear una serie por sala
+        route = request.scope.get("route")
+        request_duration.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=str(status),
+        )
+
+
+class MemoryStateStore:
+    """Estado en diccionarios del proceso: rápido, pero se pierde al reiniciar y no admite varios workers."""
+
+    def __init__(self):
+        self.users = {}  # Almacena usuarios registrados
+        self.rooms = {}  # Almacena salas activas (participantes como conjunto ordenado)
+        self.user_rooms = {}  # Índice inverso usuario -> salas
+        self.epoch = uuid4().hex[:8]
+        self.version = 0  # Cambia con cada alta/baja de sala o participante
+        self.processes = {}  # Índice sala/servidor -> proceso openvpn y puerto
+        self.allocations = {}  # Tipo de recurso -> {valor: propietario}
+        self.jobs = {}
+
+    def add_user(self, user_id: str, data: dict):
+        self.users[user_id] = dict(data)
+
+    def get_user(self, user_id: str) -> Optional[dict]:
+        user = self.users.get(user_id)
+        return dict(user) if user else None
+
+    def add_room(self, room_id: str, host_id: str, data: Optional[dict] = None):
+        self.rooms[room_id] = {"host_id": host_id, "created_at": time.time(), "participants": {host_id: None}, "data": dict(data or {})}
+        self.user_rooms.setdefault(host_id, set()).add(room_id)
+        self.version += 1
+
+    def get_room(self, room_id: str) -> Optional[dict]:
+        room = self.rooms.get(room_id)
+        if room is None:
+            return None
+        return {**room["data"], "room_id": room_id, "host_id": room["host_id"], "created_at": room["created_at"], "participants": list(room["participants"])}
+
+    def update_room(self, room_id: str, **data):
+        room = self.rooms.get(room_id)
+        if room is not None:
+            room["data"].update(data)
+
+    def delete_room(self, room_id: str) -> Optional[dict]:
+        room = self.get_room(room_id)
+        if room is None:
+            return None
+        for user_id in room["participants"]:
+            self.user_rooms.get(user_id, set()).discard(room_id)
+        del self.rooms[room_id]
+        self.version += 1
+        return room
+
+    def add_participant(self, room_id: str, user_id: str) -> bool:
+        participants = self.rooms[room_id]["participants"]
+        if user_id in participants:
+            return False
+        participants[user_id] = None
+        self.user_rooms.setdefault(user_id, set()).add(room_id)
+        self.version += 1
+        return True
+
+    def remove_participant(self, room_id: str, user_id: str) -> bool:
+        participants = self.rooms[room_id]["participants"]
+        if participants.pop(user_id, False) is False:
+            return False
+        self.user_rooms.get(user_id, set()).discard(room_id)
+        self.version += 1
+        return True
+
+    def participants(self, room_id: str) -> List[str]:
+        room = self.rooms.get(room_id)
+        return list(room["participants"]) if room else []
+
+    def rooms_of_user(self, user_id: str) -> List[str]:
+        return list(self.user_rooms.get(user_id, ()))
+
+    def list_rooms(self) -> List[dict]:
+        return [
+            {"room_id": room_id, "host_id": room["host_id"], "created_at": room["created_at"], "participants": len(room["participants"])}
+            for room_id, room in self.rooms.items()
+        ]
+
+    def rooms_version(self) -> str:
+        return f"{self.epoch}-{self.version}"
+
+    def all_rooms(self) -> List[dict]:
+        return [room for room in (self.get_room(room_id) for room_id in list(self.rooms)) if room]
+
+    def set_process(self, key: str, pid: int, port: Optional[int] = None):
+        self.processes[key] = {"pid": pid, "port": port, "started_at": time.time(), "owner": os.getpid(), "stopping": False}
+
+    def claim_process(self, key: str, port: Optional[int], stale_before: float) -> bool:
+        entry = self.processes.get(key)
+        if entry is not None and (process_alive(entry["pid"]) if entry["pid"] else entry["started_at"] >= stale_before):
+            return False
+        self.set_process(key, 0, port)
+        return True
+
+    def attach_process(self, key: str, pid: int) -> bool:
+        entry = self.processes.get(key)
+        if entry is None or entry["stopping"]:
+            return False
+        entry.update(pid=pid, started_at=time.time(), owner=os.getpid())
+        return True
+
+    def mark_process_stopping(self, key: str) -> Optional[dict]:
+        entry = self.processes.get(key)
+        if entry is not None:
+            entry["stopping"] = True
+        return entry
+
+    def get_process(self, key: str) -> Optional[dict]:
+        return self.processes.get(key)
+
+    def remove_process(self, key: str):
+        self.processes.pop(key, None)
+
+    def list_processes(self) -> Dict[str, dict]:
+        return dict(self.processes)
+
+    def claim(self, kind: str, value: int, owner: str) -> bool:
+        claims = self.allocations.setdefault(kind, {})
+        if value in claims:
+            return False
+        claims[value] = owner
+        return True
+
+    def release(self, kind: str, value: int):
+        self.allocations.get(kind, {}).pop(value, None)
+
+    def claims(self, kind: str) -> Dict[int, str]:
+        return dict(self.allocations.get(kind, {}))
+
+    def release_kind(self, kind: str):
+        self.allocations.pop(kind, None)
+
+    def release_owner(self, owner: str):
+        for claims in self.allocations.values():
+            for value in [value for value, claim_owner in claims.items() if claim_owner == owner]:
+                del claims[value]
+
+    def save_job(self, job_id: str, data: dict):
+        self.jobs[job_id] = dict(data)
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        return self.jobs.get(job_id)
+
+    def prune_jobs(self, limit: float):
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.get("finished_at") and job["finished_at"] < limit]:
+            del self.jobs[job_id]
+
+
+class SQLiteStateStore:
+    """Estado en SQLite (modo WAL) compartido por todos los workers y hosts que monten OPEN_VPN_DIR.
+
+    Las tablas están indexadas por sala -> participantes, usuario -> salas y
+    sala -> proceso/puerto, de modo que ninguna consulta recorre todas las salas.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS rooms (
+            room_id TEXT PRIMARY KEY,
+            host_id TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            data TEXT NOT NULL DEFAULT '{}'
+        );
+        CREATE TABLE IF NOT EXISTS participants (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            room_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            UNIQUE (room_id, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS participants_by_user ON participants (user_id, room_id);
+        CREATE TABLE IF NOT EXISTS processes (
+            key TEXT PRIMARY KEY,
+            pid INTEGER NOT NULL,
+            port INTEGER,
+            started_at REAL NOT NULL,
+            owner INTEGER,
+            stopping INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS processes_by_port ON processes (port);
+        CREATE TABLE IF NOT EXISTS allocations (
+            kind TEXT NOT NULL,
+            value INTEGER NOT NULL,
+            owner TEXT NOT NULL,
+            PRIMARY KEY (kind, value)
+        );
+        CREATE INDEX IF NOT EXISTS allocations_by_owner ON allocations (owner);
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            finished_at REAL
+        );
+        -- Versión de salas y participantes: los triggers la suben en cada cambio. La época
+        -- se elige al crear la base de datos, para que el contador de una base nueva no
+        -- repita versiones (y ETags) de la anterior.
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('rooms_version', 0);
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('rooms_epoch', random() & 9223372036854775807);
+        CREATE TRIGGER IF NOT EXISTS rooms_version_room_insert AFTER INSERT ON rooms
+            BEGIN UPDATE meta SET value = value + 1 WHERE key = 'rooms_version'; END;
+        CREATE TRIGGER IF NOT EXISTS rooms_version_room_delete AFTER DELETE ON rooms
+            BEGIN UPDATE meta SET value = value + 1 WHERE key = 'rooms_version'; END;
+        CREATE TRIGGER IF NOT EXISTS rooms_version_participant_insert AFTER INSERT ON participants
+            BEGIN UPDATE meta SET value = value + 1 WHERE key = 'rooms_version'; END;
+        CREATE TRIGGER IF NOT EXISTS rooms_version_participant_delete AFTER DELETE ON participants
+            BEGIN UPDATE meta SET value = value + 1 WHERE key = 'rooms_version'; END;
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn().executescript(self.SCHEMA)
+        # Bases de datos creadas antes de que existieran las columnas owner y stopping
+        for column in ("owner INTEGER", "stopping INTEGER NOT NULL DEFAULT 0"):
+            try:
+                self._conn().execute(f"ALTER TABLE processes ADD COLUMN {column}")
+            except sqlite3.OperationalError:
+                pass
+
+    # Una conexión por hilo (event loop y ejecutor)
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add_user(self, user_id: str, data: dict):
+        self._conn().execute("INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)", (user_id, json.dumps(data)))
+
+    def get_user(self, user_id: str) -> Optional[dict]:
+        row = self._conn().execute("SELECT data FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add_room(self, room_id: str, host_id: str, data: Optional[dict] = None):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT INTO rooms (room_id, host_id, created_at, data) VALUES (?, ?, ?, ?)",
+                (room_id, host_id, time.time(), json.dumps(data or {})),
+            )
+            conn.execute("INSERT INTO participants (room_id, user_id) VALUES (?, ?)", (room_id, host_id))
+
+    def get_room(self, room_id: str) -> Optional[dict]:
+        row = self._conn().execute("SELECT host_id, created_at, data FROM rooms WHERE room_id = ?", (room_id,)).fetchone()
+        if row is None:
+            return None
+        return {**json.loads(row[2]), "room_id": room_id, "host_id": row[0], "created_at": row[1], "participants": self.participants(room_id)}
+
+    def update_room(self, room_id: str, **data):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT data FROM rooms WHERE room_id = ?", (room_id,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE rooms SET data = ? WHERE room_id = ?", (json.dumps({**json.loads(row[0]), **data}), room_id))
+
+    def delete_room(self, room_id: str) -> Optional[dict]:
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            room = self.get_room(room_id)
+            if room is not None:
+                conn.execute("DELETE FROM participants WHERE room_id = ?", (room_id,))
+                conn.execute("DELETE FROM rooms WHERE room_id = ?", (room_id,))
+        return room
+
+    def add_participant(self, room_id: str, user_id: str) -> bool:
+        cursor = self._conn().execute(
+            "INSERT OR IGNORE INTO participants (room_id, user_id) VALUES (?, ?)", (room_id, user_id)
+        )
+        return cursor.rowcount == 1
+
+    def remove_participant(self, room_id: str, user_id: str) -> bool:
+        cursor = self._conn().execute(
+            "DELETE FROM participants WHERE room_id = ? AND user_id = ?", (room_id, user_id)
+        )
+        return cursor.rowcount == 1
+
+    def participants(self, room_id: str) -> List[str]:
+        rows = self._conn().execute("SELECT user_id FROM participants WHERE room_id = ? ORDER BY seq", (room_id,))
+        return [row[0] for row in rows]
+
+    def rooms_of_user(self, user_id: str) -> List[str]:
+        rows = self._conn().execute("SELECT room_id FROM participants WHERE user_id = ?", (user_id,))
+        return [row[0] for row in rows]
+
+    def list_rooms(self) -> List[dict]:
+        rows = self._conn().execute(
+            "SELECT r.room_id, r.host_id, r.created_at, COUNT(p.user_id) FROM rooms r "
+            "LEFT JOIN participants p ON p.room_id = r.room_id GROUP BY r.room_id ORDER BY r.created_at, r.room_id"
+        )
+        return [{"room_id": row[0], "host_id": row[1], "created_at": row[2], "participants": row[3]} for row in rows]
+
+    def rooms_version(self) -> str:
+        rows = dict(self._conn().execute("SELECT key, value FROM meta WHERE key IN ('rooms_epoch', 'rooms_version')"))
+        return f"{rows['rooms_epoch']:x}-{rows['rooms_version']}"
+
+    def all_rooms(self) -> List[dict]:
+        rows = self._conn().execute("SELECT room_id FROM rooms ORDER BY created_at, room_id").fetchall()
+        return [room for room in (self.get_room(row[0]) for row in rows) if room]
+
+    def set_process(self, key: str, pid: int, port: Optional[int] = None):
+        # owner es el worker que lo supervisa
+        self._conn().execute(
+            "INSERT OR REPLACE INTO processes (key, pid, port, started_at, owner) VALUES (?, ?, ?, ?, ?)",
+            (key, pid, port, time.time(), os.getpid()),
+        )
+
+    # Reserva la fila del proceso antes de lanzarlo (pid 0 = arrancando). La comprobación y la
+    # inserción van en la misma transacción, así que de dos workers solo uno lo arranca; una
+    # reserva sin PID anterior a stale_before es de un worker que murió a medias.
+    def claim_process(self, key: str, port: Optional[int], stale_before: float) -> bool:
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT pid, started_at FROM processes WHERE key = ?", (key,)).fetchone()
+            if row is not None and (process_alive(row[0]) if row[0] else row[1] >= stale_before):
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO processes (key, pid, port, started_at, owner) VALUES (?, 0, ?, ?, ?)",
+                (key, port, time.time(), os.getpid()),
+            )
+        return True
+
+    # Pone el PID del proceso ya lanzado en su fila; False si la fila ya no existe o se está parando
+    def attach_process(self, key: str, pid: int) -> bool:
+        cursor = self._conn().execute(
+            "UPDATE processes SET pid = ?, started_at = ?, owner = ? WHERE key = ? AND stopping = 0",
+            (pid, time.time(), os.getpid(), key),
+        )
+        return cursor.rowcount == 1
+
+    # Marca el proceso como parándose antes de enviarle la señal, para que el worker que lo
+    # supervisa no lo tome por una caída y lo reinicie. Devuelve la fila marcada.
+    def mark_process_stopping(self, key: str) -> Optional[dict]:
+        self._conn().execute("UPDATE processes SET stopping = 1 WHERE key = ?", (key,))
+        return self.get_process(key)
+
+    def get_process(self, key: str) -> Optional[dict]:
+        row = self._conn().execute("SELECT pid, port, started_at, owner, stopping FROM processes WHERE key = ?", (key,)).fetchone()
+        return {"pid": row[0], "port": row[1], "started_at": row[2], "owner": row[3], "stopping": bool(row[4])} if row else None
+
+    def remove_process(self, key: str):
+        self._conn().execute("DELETE FROM processes WHERE key = ?", (key,))
+
+    def list_processes(self) -> Dict[str, dict]:
+        rows = self._conn().execute("SELECT key, pid, port, started_at, owner, stopping FROM processes")
+        return {row[0]: {"pid": row[1], "port": row[2], "started_at": row[3], "owner": row[4], "stopping": bool(row[5])} for row in rows}
+
+    # La clave primaria (kind, value) hace que dos workers no puedan reservar lo mismo
+    def claim(self, kind: str, value: int, owner: str) -> bool:
+        cursor = self._conn().execute(
+            "INSERT OR IGNORE INTO allocations (kind, value, owner) VALUES (?, ?, ?)", (kind, value, owner)
+        )
+        return cursor.rowcount == 1
+
+    def release(self, kind: str, value: int):
+        self._conn().execute("DELETE FROM allocations WHERE kind = ? AND value = ?", (kind, value))
+
+    def claims(self, kind: str) -> Dict[int, str]:
+        rows = self._conn().execute("SELECT value, owner FROM allocations WHERE kind = ?", (kind,))
+        return {row[0]: row[1] for row in rows}
+
+    def release_kind(self, kind: str):
+        self._conn().execute("DELETE FROM allocations WHERE kind = ?", (kind,))
+
+    def release_owner(self, owner: str):
+        self._conn().execute("DELETE FROM allocations WHERE owner = ?", (owner,))
+
+    def save_job(self, job_id: str, data: dict):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO jobs (job_id, data, finished_at) VALUES (?, ?, ?)",
+            (job_id, json.dumps(data), data.get("finished_at")),
+        )
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        row = self._conn().execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def prune_jobs(self, limit: float):
+        self._conn().execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (limit,))
+
+
+def create_state_store():
+    if STATE_BACKEND == "memory":
+        return MemoryStateStore()
+    if STATE_BACKEND == "sqlite":
+        return SQLiteStateStore(STATE_DB)
+    raise ValueError(f"STATE_BACKEND desconocido: {STATE_BACKEND}")
+
+
+state = create_state_store()
+
+
+class AsyncStateStore:
+    """Acceso al estado desde el event loop. Con SQLite cada llamada va al ejecutor: una
+    escritura puede esperar al lock de otro worker y no debe parar el loop. El estado en
+    memoria no hace E/S y se llama directamente."""
+
+    def __init__(self, store):
+        self.store = store
+        self.offload = not isinstance(store, MemoryStateStore)
+
+    def __getattr__(self, name: str):
+        method = getattr(self.store, name)
+
+        async def call(*args, **kwargs):
+            if not self.offload:
+                return method(*args, **kwargs)
+            return await run_blocking(method, *args, **kwargs)
+
+        return call
+
+
+astate = AsyncStateStore(state)
+
+
+class AllocationError(Exception):
+    pass
+
+
+class BitmapAllocator:
+    """Reparte los índices 0..size-1 de un recurso (puertos, subredes, direcciones) en O(1).
+
+    Un bitmap marca los índices ocupados y una pila compacta guarda los libres; las
+    entradas obsoletas de la pila se descartan al sacarlas. Cada reserva se registra
+    en el estado compartido, así que sobrevive a reinicios y dos workers no pueden
+    quedarse con el mismo índice.
+    """
+
+    def __init__(self, kind: str, size: int):
+        self.kind = kind
+        self.size = size
+        self._lock = threading.Lock()
+        self._bitmap = None
+        self._free = None
+
+    def _load(self):
+        # Se reconstruye desde las reservas persistidas; también cuando se agota la pila,
+        # para ver lo que hayan liberado otros workers
+        self._bitmap = bytearray((self.size + 7) // 8)
+        for value in state.claims(self.kind):
+            if 0 <= value < self.size:
+                self._bitmap[value >> 3] |= 1 << (value & 7)
+        self._free = array("I", (value for value in range(self.size - 1, -1, -1) if not self._is_used(value)))
+
+    def _is_used(self, value: int) -> bool:
+        return bool(self._bitmap[value >> 3] & (1 << (value & 7)))
+
+    def allocate(self, owner: str) -> int:
+        with self._lock:
+            if self._bitmap is None:
+                self._load()
+            reloaded = False
+            while True:
+                if not self._free:
+                    if reloaded:
+                        raise AllocationError(f"No quedan recursos libres de tipo {self.kind}")
+                    self._load()
+                    reloaded = True
+                    continue
+                value = self._free.pop()
+                if self._is_used(value):
+                    continue
+                self._bitmap[value >> 3] |= 1 << (value & 7)
+                if state.claim(self.kind, value, owner):
+                    return value
+
+    def release(self, value: int):
+        with self._lock:
+            state.release(self.kind, value)
+            if self._bitmap is not None and self._is_used(value):
+                self._bitmap[value >> 3] &= ~(1 << (value & 7))
+                self._free.append(value)
+
+    def stats(self) -> dict:
+        # Se recarga para contar también lo que han reservado y liberado otros workers
+        with self._lock:
+            self._load()
+            used = sum(bin(byte).count("1") for byte in self._bitmap)
+        return {"size": self.size, "used": used, "free": self.size - used}
+
+
+def parse_port_range(value: str):
+    first, _, last = value.partition("-")
+    return int(first), int(last or first)
+
+
+PORT_RANGE = parse_port_range(VPN_PORT_RANGE)
+SUBNET_POOL = ipaddress.ip_network(VPN_SUBNET_POOL)
+port_allocator = BitmapAllocator(f"port/{VPN_PROTO}", PORT_RANGE[1] - PORT_RANGE[0] + 1)
+subnet_allocator = BitmapAllocator("subnet", 2 ** (ROOM_SUBNET_PREFIX - SUBNET_POOL.prefixlen))
+
+
+# Subred número `index` de tamaño `prefix` dentro de `network`, sin enumerar las anteriores
+def nth_subnet(network: ipaddress.IPv4Network, prefix: int, index: int) -> ipaddress.IPv4Network:
+    block = 2 ** (32 - prefix)
+    return ipaddress.ip_network((int(network.network_address) + index * block, prefix))
+
+
+# Reserva puerto y subred para el servidor openvpn de una sala
+def allocate_room_network(room_id: str) -> dict:
+    port_index = port_allocator.allocate(room_id)
+    try:
+        subnet_index = subnet_allocator.allocate(room_id)
+    except AllocationError:
+        port_allocator.release(port_index)
+        raise
+    subnet = nth_subnet(SUBNET_POOL, ROOM_SUBNET_PREFIX, subnet_index)
+    return {
+        "port": PORT_RANGE[0] + port_index,
+        "proto": VPN_PROTO,
+        "subnet": str(subnet),
+        "subnet_index": subnet_index,
+    }
+
+
+def release_room_network(room: dict):
+    # Las salas multiplexadas usan el puerto del servidor compartido y una subred suya
+    if "server" in room:
+        return
+    if room.get("port") is not None:
+        port_allocator.release(room["port"] - PORT_RANGE[0])
+    if room.get("subnet_index") is not None:
+        subnet_allocator.release(room["subnet_index"])
+
+
+# Ruta: Ocupación de puertos y subredes
+@app.get("/allocations")
+async def get_allocations():
+    return {"ports": await run_blocking(port_allocator.stats), "subnets": await run_blocking(subnet_allocator.stats)}
+
+
+
+
+class AdoptedProcess:
+    """Proceso openvpn que no es hijo de este worker (otra ejecución u otro worker): se vigila por PID."""
+
+    stdout = None
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self._returncode = None
+
+    @property
+    def returncode(self):
+        if self._returncode is None and not process_alive(self.pid):
+            self._returncode = -1
+        return self._returncode
+
+    def terminate(self):
+        self._signal(signal.SIGTERM)
+
+    def kill(self):
+        self._signal(signal.SIGKILL)
+
+    def _signal(self, signum):
+        try:
+            os.kill(self.pid, signum)
+        except ProcessLookupError:
+            pass
+
+    async def wait(self):
+        while self.returncode is None:
+            await asyncio.sleep(0.2)
+        return self._returncode
+
+
+def process_alive(pid: int) -> bool:
+    if pid <= 0:
+        return False  # Reserva de arranque sin proceso todavía (y kill(0) señalaría a nuestro grupo)
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # Un zombi ya terminó aunque su PID siga existiendo
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except (OSError, IndexError):
+        return True
+
+
+# Procesos openvpn en ejecución cuya configuración está dentro de OPEN_VPN_DIR
+def openvpn_processes() -> Dict[int, str]:
+    found = {}
+    if not os.path.isdir("/proc"):
+        return found
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/cmdline", "rb") as f:
+                args = f.read().decode(errors="replace").split("\0")
+        except OSError:
+            continue
+        if args and os.path.basename(args[0]) == "openvpn" and any(arg.startswith(OPEN_VPN_DIR) for arg in args):
+            found[int(entry)] = " ".join(args).strip()
+    return found
+
+
+# Devuelve el proceso openvpn de una sala; si lo supervisa otro worker, un handle por PID
+def get_room_process(key: str):
+    process = supervisor.get(key)
+    if process is None:
+        entry = state.get_process(key)
+        if entry and process_alive(entry["pid"]):
+            process = AdoptedProcess(entry["pid"])
+    return process
+
+
+class RotatingLog:
+    """Log de un proceso con tamaño máximo: al llenarse rota a .1, .2, ... hasta `backups` copias."""
+
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._file = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def write(self, data: bytes):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+                self._size = self._file.tell()
+            if self._size and self._size + len(data) > self.max_bytes:
+                self._rotate()
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, "ab")
+        self._size = 0
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class ProcessStopped(Exception):
+    pass
+
+
+class ProcessSupervisor:
+    """Lanza y vigila los procesos openvpn de este worker.
+
+    Vacía la salida de cada hijo en un log rotativo por sala (si nadie lee el pipe,
+    openvpn se bloquea al llenarse), recoge su salida sin bloquear el event loop,
+    lo reinicia con backoff exponencial si muere inesperadamente y lo para en
+    segundo plano escalando de terminate a kill.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self._stopping = set()
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        return entry["process"] if entry else None
+
+    def _new_entry(self, key: str, args: List[str], cwd: str, port: Optional[int]) -> dict:
+        entry = {
+            "key": key,
+            "args": list(args),
+            "cwd": cwd,
+            "port": port,
+            "process": None,
+            "state": "starting",
+            "started_at": None,
+            "restarts": 0,
+            "failure_streak": 0,
+            "last_exit_code": None,
+            "stopping": False,
+            "adopted": False,
+            "log": RotatingLog(os.path.join(cwd, "openvpn.log"), PROCESS_LOG_MAX_BYTES, PROCESS_LOG_BACKUPS),
+            "watcher": None,
+        }
+        self.entries[key] = entry
+        return entry
+
+    # claimed: el llamador ya reservó la fila del proceso con claim_process
+    async def start(self, key: str, args: List[str], cwd: str, port: Optional[int] = None, claimed: bool = False):
+        entry = self._new_entry(key, args, cwd, port)
+        try:
+            if not claimed:
+                await astate.set_process(key, 0, port)
+            # Hasta que haya watcher, stop() cancela el arranque en curso
+            spawn = entry["watcher"] = asyncio.create_task(self._spawn(entry))
+            try:
+                await spawn
+            except asyncio.CancelledError:
+                if entry["stopping"] and spawn.cancelled():
+                    raise ProcessStopped(f"openvpn for {key} was stopped while starting")
+                raise
+            if entry["stopping"]:
+                raise ProcessStopped(f"openvpn for {key} was stopped while starting")
+        except BaseException:
+            if self.entries.get(key) is entry:
+                del self.entries[key]
+            entry["log"].close()
+            await astate.remove_process(key)
+            raise
+        entry["watcher"] = asyncio.create_task(self._watch(entry))
+        return entry["process"]
+
+    # Vigila un openvpn que sigue vivo de otra ejecución; sus argumentos se leen de /proc
+    async def adopt(self, key: str, pid: int, port: Optional[int] = None, started_at: Optional[float] = None):
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                args = [arg for arg in f.read().decode(errors="replace").split("\0") if arg]
+            cwd = os.readlink(f"/proc/{pid}/cwd")
+        except OSError:
+            args, cwd = [], os.path.join(OPEN_VPN_DIR, key)
+        entry = self._new_entry(key, args, cwd, port)
+        entry.update(process=AdoptedProcess(pid), state="running", started_at=started_at or time.time(), adopted=True)
+        await astate.set_process(key, pid, port)
+        entry["watcher"] = asyncio.create_task(self._watch(entry))
+        return entry["process"]
+
+    async def _spawn(self, entry: dict):
+        process = await asyncio.create_subprocess_exec(
+            *entry["args"],
+            cwd=entry["cwd"],
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            # Hereda SIGPIPE ignorado: si este worker cae, openvpn sigue vivo y se puede re-adoptar
+            restore_signals=False,
+        )
+        entry.update(process=process, state="running", started_at=time.time(), adopted=False)
+        # Parado (aquí o desde otro worker) mientras arrancaba: el hijo nuevo no debe quedar vivo
+        if not await astate.attach_process(entry["key"], process.pid) or entry["stopping"]:
+            await self._end(entry["key"], process)
+            raise ProcessStopped(f"openvpn for {entry['key']} was stopped while starting")
+
+    async def _end(self, key: str, process):
+        process.terminate()  # Terminate gracefully
+        try:
+            await asyncio.wait_for(process.wait(), timeout=STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.error(f"Error terminating openvpn process for {key}, killing it")
+            process.kill()
+            await process.wait()
+
+    async def _drain(self, entry: dict, stream):
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                break
+            await run_blocking(entry["log"].write, chunk)
+
+    async def _watch(self, entry: dict):
+        key = entry["key"]
+        while True:
+            process = entry["process"]
+            if getattr(process, "stdout", None) is not None:
+                await self._drain(entry, process.stdout)
+            entry["last_exit_code"] = await process.wait()
+            if entry["stopping"]:
+                return
+            if await self._stopped_elsewhere(entry):
+                entry["state"] = "stopped"
+                self._forget(entry)
+                logging.info(f"openvpn for {key} was stopped by another worker")
+                return
+            uptime = time.time() - entry["started_at"]
+            logging.error(f"openvpn for {key} exited with code {entry['last_exit_code']} after {uptime:.0f}s")
+            failures_total.inc(operation="openvpn_exit")
+            # Un proceso que aguantó un rato no cuenta como fallo en racha
+            if uptime >= SUPERVISOR_STABLE_SECONDS:
+                entry["failure_streak"] = 0
+            while True:
+                if entry["failure_streak"] >= SUPERVISOR_MAX_RESTARTS or not entry["args"]:
+                    entry["state"] = "failed"
+                    await astate.remove_process(key)
+                    logging.error(f"openvpn for {key} failed permanently, giving up")
+                    return
+                delay = min(SUPERVISOR_BACKOFF * 2 ** entry["failure_streak"], SUPERVISOR_BACKOFF_MAX)
+                entry["failure_streak"] += 1
+                entry["state"] = "restarting"
+                await asyncio.sleep(delay)
+                if entry["stopping"]:
+                    return
+                try:
+                    await self._spawn(entry)
+                except ProcessStopped:
+                    entry["state"] = "stopped"
+                    self._forget(entry)
+                    return
+                except Exception as e:
+                    logging.error(f"Error restarting openvpn for {key}: {e}")
+                    continue
+                entry["restarts"] += 1
+                logging.info(f"openvpn for {key} restarted (pid {entry['process'].pid})")
+                break
+
+    # Otro worker lo paró (fila marcada o ya borrada) o su sala ya no existe
+    async def _stopped_elsewhere(self, entry: dict) -> bool:
+        key = entry["key"]
+        record = await astate.get_process(key)
+        if record is None or record["stopping"]:
+            return True
+        if is_room_id(key) and await astate.get_room(key) is None:
+            await astate.remove_process(key)
+            return True
+        return False
+
+    def _forget(self, entry: dict):
+        if self.entries.get(entry["key"]) is entry:
+            del self.entries[entry["key"]]
+        entry["log"].close()
+
+    # Para el proceso en segundo plano y devuelve la tarea; la llamada no bloquea
+    def stop(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            # Proceso de otro worker: solo lo conocemos por su PID en el estado compartido,
+            # que se lee ya en la tarea de parada
+            entry = {"key": key, "process": None, "log": None, "watcher": None, "foreign": True}
+        entry["stopping"] = True
+        entry["state"] = "stopping"
+        # Un watcher dormido en el backoff (o un arranque en curso) no debe retrasar la parada
+        if entry["watcher"] is not None:
+            entry["watcher"].cancel()
+        task = asyncio.create_task(self._terminate(entry))
+        self._stopping.add(task)
+        task.add_done_callback(self._stopping.discard)
+        return task
+
+    async def _terminate(self, entry: dict):
+        key = entry["key"]
+        try:
+            # Primero la marca en el estado y después la señal: así el worker que lo supervisa
+            # no reinicia un proceso que otro está parando
+            record = await astate.mark_process_stopping(key)
+            if entry["watcher"] is not None:
+                await asyncio.gather(entry["watcher"], return_exceptions=True)
+            # Se lee después de esperar al watcher: un arranque cancelado puede haber dejado un hijo nuevo
+            process = entry["process"]
+            if entry.get("foreign") and record is not None and process_alive(record["pid"]):
+                process = AdoptedProcess(record["pid"])
+            if process is not None and process.returncode is None:
+                await self._end(key, process)
+        finally:
+            entry["state"] = "stopped"
+            if entry["log"] is not None:
+                entry["log"].close()
+            await astate.remove_process(key)
+
+    def health(self, key: str) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        process = entry["process"]
+        running = process is not None and process.returncode is None
+        return {
+            "state": entry["state"] if entry["state"] != "running" or running else "exited",
+            "pid": process.pid if process is not None else None,
+            "uptime_seconds": round(time.time() - entry["started_at"], 1) if running else 0,
+            "restarts": entry["restarts"],
+            "last_exit_code": entry["last_exit_code"],
+            "adopted": entry["adopted"],
+            "log_file": entry["log"].path,
+        }
+
+    async def shutdown(self):
+        # Los openvpn siguen vivos y se re-adoptan al arrancar; solo esperamos las paradas en curso
+        if self._stopping:
+            await asyncio.gather(*self._stopping, return_exceptions=True)
+        for entry in self.entries.values():
+            if entry["watcher"] is not None:
+                entry["watcher"].cancel()
+            entry["log"].close()
+
+
+supervisor = ProcessSupervisor()
+
+
+# Exclusión entre workers para las tareas de arranque (reconciliación y servidores compartidos).
+# El lock se libera al cerrar el fichero devuelto.
+def acquire_state_lock():
+    os.makedirs(OPEN_VPN_DIR, exist_ok=True)
+    lock_file = open(os.path.join(OPEN_VPN_DIR, ".state.lock"), "a+")
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+@contextmanager
+def state_lock():
+    lock_file = acquire_state_lock()
+    try:
+        yield
+    finally:
+        lock_file.close()
+
+
+def remove_room_dir(room_id: str):
+    shutil.rmtree(os.path.join(OPEN_VPN_DIR, room_id), ignore_errors=True)
+
+
+def is_room_id(name: str) -> bool:
+    try:
+        uuid.UUID(name)
+    except ValueError:
+        return False
+    return True
+
+
+# Al arrancar: elige los openvpn vivos que hay que re-adoptar, limpia salas cuyo servidor
+# murió y mata huérfanos. Devuelve los procesos a adoptar (la supervisión vive en el event loop).
+def reconcile_state() -> Dict[str, dict]:
+    to_adopt = {}
+    with state_lock():
+        removed = 0
+        known_pids = set()
+        for key, entry in state.list_processes().items():
+            if not entry["pid"] and entry["started_at"] >= time.time() - RECONCILE_GRACE:
+                continue  # Otro worker lo está arrancando ahora mismo
+            if process_alive(entry["pid"]):
+                known_pids.add(entry["pid"])
+                # Si el worker que lo supervisaba sigue vivo, es suyo
+                if entry.get("owner") in (None, os.getpid()) or not process_alive(entry["owner"]):
+                    to_adopt[key] = entry
+                continue
+            # La sala se conserva: su servidor vuelve a arrancar cuando alguien entra o la activa
+            state.remove_process(key)
+        if VPN_MODE != "multiplexed":
+            # Salas cuya creación no terminó (sin server.conf) y que ya no están en creación
+            limit = time.time() - RECONCILE_GRACE
+            for room in state.all_rooms():
+                config_file = os.path.join(OPEN_VPN_DIR, room["room_id"], "server.conf")
+                if room["created_at"] < limit and state.get_process(room["room_id"]) is None and not os.path.exists(config_file):
+                    state.delete_room(room["room_id"])
+                    state.release_owner(room["room_id"])
+                    remove_room_dir(room["room_id"])
+                    removed += 1
+        for pid, cmdline in openvpn_processes().items():
+            if pid not in known_pids:
+                logging.warning(f"Terminating orphaned openvpn process {pid}: {cmdline}")
+                AdoptedProcess(pid).terminate()
+        if os.path.isdir(OPEN_VPN_DIR):
+            for name in os.listdir(OPEN_VPN_DIR):
+                if is_room_id(name) and state.get_room(name) is None:
+                    remove_room_dir(name)
+    logging.info(f"State reconciled: {len(to_adopt)} openvpn processes adopted, {removed} stale rooms removed")
+    return to_adopt
+
+
+async def start_state_reconciliation():
+    to_adopt = await run_blocking(reconcile_state)
+    for key, entry in to_adopt.items():
+        await supervisor.adopt(key, entry["pid"], entry["port"], entry["started_at"])
+
+
+async def stop_supervisor():
+    await supervisor.shutdown()
+
+
+def dh_params_command(out_file: str):
+    return ["openssl", "dhparam", "-out", out_file, str(DH_BITS)]
+
+
+# Genera un fichero de parámetros DH con openssl (operación lenta: segundos o minutos)
+def generate_dh_params(out_file: str):
+    subprocess.run(dh_params_command(out_file), check = True)
+
+
+class DHParamPool:
+    """Pool en disco de ficheros dh.pem que un hilo en segundo plano rellena hasta `size`.
+
+    `take` mueve un fichero ya generado al directorio de la sala en O(1) (un rename);
+    si el pool está vacío devuelve False y el llamador genera los parámetros él mismo.
+    """
+
+    def __init__(self, directory: str, size: int):
+        self.directory = directory
+        self.size = size
+        self._files = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.started_at = None
+        self.generated = 0
+        self.taken = 0
+        self.misses = 0
+        self.failures = 0
+        self.generation_seconds = 0.0
+
+    def load(self):
+        # Recupera los ficheros generados antes de un reinicio
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            self._files.clear()
+            for name in sorted(os.listdir(self.directory)):
+                path = os.path.join(self.directory, name)
+                if name.endswith(".pem"):
+                    self._files.append(path)
+                elif name.endswith(".tmp") and os.path.getmtime(path) < time.time() - 3600:
+                    # Generación interrumpida por un reinicio: el fichero está incompleto
+                    os.remove(path)
+        logging.info(f"DH pool loaded: {len(self._files)} parameter files in {self.directory}")
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self.load()
+        self._stop.clear()
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="dh-pool", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def depth(self) -> int:
+        with self._lock:
+            return len(self._files)
+
+    # Ficheros listos en disco, incluidos los que han generado otros workers
+    def available(self) -> int:
+        return len(self._scan())
+
+    def _scan(self):
+        try:
+            return [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory)) if name.endswith(".pem")]
+        except FileNotFoundError:
+            return []
+
+    def take(self, dest: str) -> bool:
+        while True:
+            with self._lock:
+                if not self._files:
+                    # Puede haber ficheros generados por otros workers que comparten el directorio
+                    self._files.extend(self._scan())
+                if not self._files:
+                    self.misses += 1
+                    break
+                path = self._files.popleft()
+            try:
+                os.replace(path, dest)
+            except FileNotFoundError:
+                # Otro proceso ya consumió este fichero; probamos con el siguiente
+                continue
+            with self._lock:
+                self.taken += 1
+            self._wakeup.set()
+            return True
+        self._wakeup.set()
+        return False
+
+    # Devuelve al pool un fichero que no llegó a usarse (una sala que falló al crearse)
+    def put_back(self, path: str):
+        os.makedirs(self.directory, exist_ok=True)
+        dest = os.path.join(self.directory, f"dh-{uuid4().hex}.pem")
+        try:
+            os.replace(path, dest)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._files.append(dest)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            # La profundidad se mide en disco para que varios workers no rellenen el pool por duplicado
+            if len(self._scan()) >= self.size:
+                self._wakeup.wait(timeout=30)
+                continue
+            name = f"dh-{uuid4().hex}"
+            tmp_file = os.path.join(self.directory, f"{name}.tmp")
+            dh_file = os.path.join(self.directory, f"{name}.pem")
+            start = time.monotonic()
+            try:
+                generate_dh_params(tmp_file)
+                os.replace(tmp_file, dh_file)
+            except Exception as e:
+                logging.error(f"Error generating DH parameters for pool: {e}")
+                with self._lock:
+                    self.failures += 1
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                self._stop.wait(10)
+                continue
+            elapsed = time.monotonic() - start
+            with self._lock:
+                self._files.append(dh_file)
+                self.generated += 1
+                self.generation_seconds += elapsed
+            logging.info(f"DH parameters added to pool in {elapsed:.1f}s (depth={self.depth()}/{self.size})")
+
+    def stats(self) -> dict:
+        with self._lock:
+            depth = len(self._files)
+            generated = self.generated
+            avg = self.generation_seconds / generated if generated else None
+        uptime = time.monotonic() - self.started_at if self.started_at else 0.0
+        return {
+            "depth": depth,
+            "size": self.size,
+            "generated": generated,
+            "taken": self.taken,
+            "misses": self.misses,
+            "failures": self.failures,
+            "avg_generation_seconds": round(avg, 3) if avg else None,
+            # Ritmo de relleno observado y el máximo teórico con un solo hilo generador
+            "refill_rate_per_minute": round(generated * 60 / uptime, 3) if uptime else 0.0,
+            "max_refill_rate_per_minute": round(60 / avg, 3) if avg else None,
+        }
+
+
+dh_pool = DHParamPool(DH_POOL_DIR, DH_POOL_SIZE)
+
+
+# En modo multiplexado solo se usan parámetros DH al arrancar cada servidor compartido
+def start_dh_pool():
+    if DH_POOL_SIZE > 0 and VPN_MODE != "multiplexed":
+        dh_pool.start()
+
+
+def stop_dh_pool():
+    dh_pool.stop()
+
+
+# Ruta: Estado del pool de parámetros DH
+@app.get("/dh-pool")
+async def get_dh_pool():
+    return dh_pool.stats()
+
+# Genera una clave privada de cliente del tipo configurado
+def generate_client_key():
+    if CLIENT_KEY_TYPE == "ecdsa":
+        return ec.generate_private_key(ec.SECP256R1())
+    return rsa.generate_private_key(public_exponent=65537, key_size=CLIENT_KEY_BITS)
+
+
+# El CA se leyó bien pero no sirve para firmar: clave de otro certificado, caducado o no es CA
+class InvalidCertificateAuthority(Exception):
+    pass
+
+
+class CertificateAuthority:
+    """Firma certificados de cliente en memoria con la clave del CA cargada una sola vez.
+
+    Mantiene un pool de pares de claves que un hilo en segundo plano rellena, reserva
+    números de serie por bloques en demoCA/serial (con flock, para varios procesos) y
+    añade cada certificado emitido a demoCA/index.txt con el formato de `openssl ca`.
+    """
+
+    def __init__(self, key_file: str, cert_file: str, pool_size: int):
+        self.key_file = key_file
+        self.cert_file = cert_file
+        self.pool_size = pool_size
+        self.ca_key = None
+        self.ca_cert = None
+        self.ready = False
+        self._keys = deque()
+        self._lock = threading.Lock()
+        self._serial_lock = threading.Lock()
+        self._next_serial = 0
+        self._serial_limit = 0
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.issued = 0
+        self.pool_misses = 0
+        self.serial_file = os.path.join(OPEN_VPN_DIR, "demoCA/serial")
+        self.index_file = os.path.join(OPEN_VPN_DIR, "demoCA/index.txt")
+
+    def load(self):
+        with open(self.key_file, "rb") as f:
+            self.ca_key = serialization.load_pem_private_key(f.read(), password=None)
+        with open(self.cert_file, "rb") as f:
+            self.ca_cert = x509.load_pem_x509_certificate(f.read())
+        self.validate()
+        self.ready = True
+        logging.info(f"Certificate authority loaded: {self.ca_cert.subject.rfc4514_string()}")
+
+    # Comprueba que la clave corresponde al certificado y que este es un CA vigente
+    def validate(self):
+        public_format = (serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+        if self.ca_key.public_key().public_bytes(*public_format) != self.ca_cert.public_key().public_bytes(*public_format):
+            raise InvalidCertificateAuthority("La clave del CA no corresponde a su certificado")
+        try:
+            constraints = self.ca_cert.extensions.get_extension_for_class(x509.BasicConstraints).value
+        except x509.ExtensionNotFound:
+            constraints = None
+        if constraints is not None and not constraints.ca:
+            raise InvalidCertificateAuthority("El certificado del CA no es de una autoridad de certificación")
+        now = datetime.now(timezone.utc)
+        if not self.ca_cert.not_valid_before_utc <= now <= self.ca_cert.not_valid_after_utc:
+            raise InvalidCertificateAuthority(f"El certificado del CA no está vigente (caduca {self.ca_cert.not_valid_after_utc.isoformat()})")
+
+    def start(self):
+        self.load()
+        self._stop.clear()
+        if self.pool_size > 0:
+            self._thread = threading.Thread(target=self._run, name="client-key-pool", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.clear()
+            with self._lock:
+                missing = self.pool_size - len(self._keys)
+            if missing <= 0:
+                self._wakeup.wait(timeout=30)
+                continue
+            key = generate_client_key()
+            with self._lock:
+                self._keys.append(key)
+
+    def take_key(self):
+        with self._lock:
+            key = self._keys.popleft() if self._keys else None
+            if key is None:
+                self.pool_misses += 1
+        self._wakeup.set()
+        return key or generate_client_key()
+
+    # Reserva un bloque de números de serie para no tocar el disco en cada emisión
+    def _reserve_serials(self):
+        with open(self.serial_file, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            current = int(f.read().strip() or "01", 16)
+            f.seek(0)
+            f.truncate()
+            f.write(f"{current + SERIAL_BLOCK:02X}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._next_serial = current
+        self._serial_limit = current + SERIAL_BLOCK
+
+    def next_serial(self) -> int:
+        with self._serial_lock:
+            if self._next_serial >= self._serial_limit:
+                self._reserve_serials()
+            serial = self._next_serial
+            self._next_serial += 1
+            return serial
+
+    def _append_index(self, serial: int, not_after: datetime, subject: str):
+        serial_hex = f"{serial:X}"
+        if len(serial_hex) % 2:
+            serial_hex = "0" + serial_hex
+        line = f"V\t{not_after.strftime('%y%m%d%H%M%SZ')}\t\t{serial_hex}\tunknown\t{subject}\n"
+        with open(self.index_file, "a") as f:
+            f.write(line)
+
+    def issue(self, common_name: str):
+        with stage_duration.time(stage="key_generation"):
+            key = self.take_key()
+        with stage_duration.time(stage="ca_signing"):
+            return self._sign(common_name, key)
+
+    def _sign(self, common_name: str, key):
+        subject = x509.Name([
+            x509.NameAttribute(NameOID.COMMON_NAME, common_name),
+            x509.NameAttribute(NameOID.COUNTRY_NAME, "US"),
+            x509.NameAttribute(NameOID.STATE_OR_PROVINCE_NAME, "ExampleState"),
+            x509.NameAttribute(NameOID.ORGANIZATION_NAME, "ExampleOrg"),
+        ])
+        now = datetime.now(timezone.utc)
+        not_after = now + timedelta(days=CLIENT_CERT_DAYS)
+        serial = self.next_serial()
+        is_rsa = CLIENT_KEY_TYPE != "ecdsa"
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(self.ca_cert.subject)
+            .public_key(key.public_key())
+            .serial_number(serial)
+            .not_valid_before(now - timedelta(minutes=5))
+            .not_valid_after(not_after)
+            .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+            .add_extension(x509.KeyUsage(
+                digital_signature=True, content_commitment=False, key_encipherment=is_rsa,
+                data_encipherment=False, key_agreement=not is_rsa, key_cert_sign=False,
+                crl_sign=False, encipher_only=False, decipher_only=False,
+            ), critical=True)
+            .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.CLIENT_AUTH]), critical=False)
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+            .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(self.ca_key.public_key()), critical=False)
+            .sign(self.ca_key, hashes.SHA256())
+        )
+        self._append_index(serial, not_after, f"/CN={common_name}/C=US/ST=ExampleState/O=ExampleOrg")
+        with self._lock:
+            self.issued += 1
+        cert_content = cert.public_bytes(serialization.Encoding.PEM).decode()
+        key_content = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ).decode()
+        return {"cert_content": cert_content, "key_content": key_content}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.ready,
+                "key_type": CLIENT_KEY_TYPE,
+                "key_pool_depth": len(self._keys),
+                "key_pool_size": self.pool_size,
+                "key_pool_misses": self.pool_misses,
+                "issued": self.issued,
+            }
+
+
+certificate_authority = CertificateAuthority(CA_KEY_FILE, CA_CERT_FILE, CLIENT_KEY_POOL_SIZE)
+
+
+# Sin cryptography, o con un CA que cryptography no sabe leer, se firma con openssl.
+# Un CA que se lee pero no valida es un error de arranque: sus certificados no servirían.
+def start_certificate_authority():
+    if x509 is None:
+        logging.warning("cryptography not installed, client certificates will be signed with openssl")
+        return
+    try:
+        certificate_authority.start()
+    except InvalidCertificateAuthority:
+        raise
+    except Exception as e:
+        logging.error(f"Error loading certificate authority, falling back to openssl: {e}")
+
+
+def stop_certificate_authority():
+    certificate_authority.stop()
+
+
+# Ruta: Estado del emisor de certificados de cliente
+@app.get("/ca")
+async def get_ca():
+    return certificate_authority.stats()
+
+# Trabajos en segundo plano para /create-room y /join-room en modo job.
+# Aquí viven las tareas de este worker; el resultado se guarda en el estado compartido.
+jobs = {}
+
+
+async def create_job(kind: str, coro) -> dict:
+    job_id = str(uuid4())
+    job = {
+        "job_id": job_id,
+        "type": kind,
+        "status": "pending",
+        "result": None,
+        "error": None,
+        "status_code": None,
+        "created_at": time.time(),
+        "finished_at": None,
+        "done": asyncio.Event(),
+    }
+    jobs[job_id] = job
+    await astate.save_job(job_id, job_view(job))
+    job["task"] = asyncio.create_task(run_job(job, coro))
+    return job
+
+
+def job_view(job: dict) -> dict:
+    return {key: value for key, value in job.items() if key not in ("done", "task")}
+
+
+async def run_job(job: dict, coro):
+    job["status"] = "running"
+    await astate.save_job(job["job_id"], job_view(job))
+    try:
+        job["result"] = await coro
+        job["status"] = "done"
+        job["status_code"] = 200
+    except HTTPException as e:
+        job["status"] = "failed"
+        job["error"] = e.detail
+        job["status_code"] = e.status_code
+    except Exception as e:
+        logging.error(f"Job {job['job_id']} failed: {e}")
+        job["status"] = "failed"
+        job["error"] = str(e)
+        job["status_code"] = 500
+    finally:
+        job["finished_at"] = time.time()
+        await astate.save_job(job["job_id"], job_view(job))
+        job["done"].set()
+        del jobs[job["job_id"]]
+        # Elimina los trabajos terminados hace más de JOB_TTL segundos
+        await astate.prune_jobs(time.time() - JOB_TTL)
+
+
+def job_accepted(job: dict, **extra) -> JSONResponse:
+    return JSONResponse(
+        status_code=202,
+        content={"job_id": job["job_id"], "status": job["status"], "status_url": f"/jobs/{job['job_id']}", **extra},
+    )
+
+
+# Ruta: Consultar un trabajo (con wait > 0 espera hasta que termine, como long-poll)
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0):
+    deadline = time.monotonic() + min(wait, JOB_MAX_WAIT)
+    while True:
+        job = jobs.get(job_id)
+        if job is not None and wait > 0:
+            # Trabajo de este worker: esperamos a su evento sin sondear
+            try:
+                await asyncio.wait_for(job["done"].wait(), timeout=max(deadline - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+        result = await astate.get_job(job_id)
+        if result is None:
+            raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+        if result["finished_at"] or time.monotonic() >= deadline:
+            return result
+        # Trabajo de otro worker: sondeamos el estado compartido hasta el plazo
+        await asyncio.sleep(0.25)
 
-# Estructuras en memoria (reemplazables por una base de datos)
-users = {}  # Almacena usuarios registrados
-rooms = {}  # Almacena salas activas
-# Directorio de configuraciones OpenVPN
-OPEN_VPN_DIR = os.environ.get("OPEN_VPN_DIR", "/tmp/openvpn_rooms")
-SERVER_IP = socket.gethostbyname(socket.gethostname())
 
+# Control de admisión: cada clase de trabajo pesado (DH, claves/firma, arranque de openvpn)
+# tiene un límite de trabajos simultáneos y una cola FIFO acotada que se reparte por turnos
+# entre usuarios. Si la cola está llena se responde 429 con Retry-After.
+admission_wait = Histogram("vpn_admission_wait_seconds", "Espera en la cola de admisión por clase de trabajo", ("work_class",))
+admission_rejected_total = Counter("vpn_admission_rejected_total", "Peticiones rechazadas por cola llena", ("work_class",))
+
+
+class WorkQueue:
+    """Limita los trabajos simultáneos de una clase y encola el resto de forma justa.
+
+    Las esperas se guardan por usuario (FIFO dentro de cada uno) y al liberarse un hueco
+    se atiende al siguiente usuario por turnos, de modo que uno solo no acapara la cola.
+    El tiempo de servicio observado (media móvil) da el Retry-After de los rechazos.
+    """
+
+    def __init__(self, name: str, limit: int, queue_size: int, user_queue_size: int):
+        self.name = name
+        self.limit = max(limit, 1)
+        self.queue_size = queue_size
+        self.user_queue_size = user_queue_size
+        self.active = 0
+        self.queued = 0
+        self._waiters = OrderedDict()
+        self.service_time = None
+        self.admitted = 0
+        self.rejected = 0
+
+    def retry_after(self) -> int:
+        # Tiempo hasta que se vacíe lo que hay delante, repartido entre los huecos
+        service_time = self.service_time or 1.0
+        return max(1, math.ceil(service_time * (self.queued + self.active) / self.limit))
+
+    def saturated(self, user_id: Optional[str] = None) -> bool:
+        if self.active < self.limit and not self.queued:
+            return False
+        if self.queued >= self.queue_size:
+            return True
+        return len(self._waiters.get(user_id, ())) >= self.user_queue_size
+
+    def reject(self):
+        self.rejected += 1
+        admission_rejected_total.inc(work_class=self.name)
+        raise HTTPException(
+            status_code=429,
+            detail="Servidor ocupado, inténtalo más tarde",
+            headers={"Retry-After": str(self.retry_after())},
+        )
+
+    @asynccontextmanager
+    async def slot(self, user_id: Optional[str] = None):
+        enqueued_at = time.monotonic()
+        if self.active < self.limit and not self.queued:
+            self.active += 1
+        else:
+            if self.saturated(user_id):
+                self.reject()
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(user_id, deque()).append(waiter)
+            self.queued += 1
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                queue = self._waiters.get(user_id)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    self.queued -= 1
+                    if not queue:
+                        del self._waiters[user_id]
+                elif not waiter.cancelled():
+                    # Ya se nos había cedido el hueco: lo pasamos al siguiente
+                    self._release()
+                raise
+        self.admitted += 1
+        admission_wait.observe(time.monotonic() - enqueued_at, work_class=self.name)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            self.service_time = elapsed if self.service_time is None else 0.8 * self.service_time + 0.2 * elapsed
+            self._release()
+
+    def _release(self):
+        # El hueco pasa directamente al primer usuario en turno (active no cambia)
+        while self._waiters:
+            user_id, queue = next(iter(self._waiters.items()))
+            waiter = queue.popleft()
+            self.queued -= 1
+            if queue:
+                self._waiters.move_to_end(user_id)
+            else:
+                del self._waiters[user_id]
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": self.queued,
+            "queue_size": self.queue_size,
+            "waiting_users": len(self._waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_service_seconds": round(self.service_time, 3) if self.service_time is not None else None,
+            "retry_after": self.retry_after(),
+        }
+
+
+admission = {
+    "dh": WorkQueue("dh", DH_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_USER_QUEUE_SIZE),
+    "crypto": WorkQueue("crypto", CRYPTO_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_USER_QUEUE_SIZE),
+    "spawn": WorkQueue("spawn", SPAWN_CONCURRENCY, ADMISSION_QUEUE_SIZE, ADMISSION_USER_QUEUE_SIZE),
+}
+
+
+# Rechaza con 429 antes de tocar el estado si alguna de las colas que necesitará está llena
+def check_admission(user_id: str, *work_classes: str):
+    for work_class in work_classes:
+        if admission[work_class].saturated(user_id):
+            admission[work_class].reject()
+
+
+# Ruta: Estado del control de admisión
+@app.get("/admission")
+async def get_admission():
+    return {name: queue.stats() for name, queue in admission.items()}
 
-# Modelo para los templates
-template_loader = jinja2.FileSystemLoader(searchpath="./templates")
-template_env = jinja2.Environment(loader=template_loader)
 
 # Modelos
 class User(BaseModel):
@@ -63,230 +1934,917 @@ async def register_user(user: User, request: Request):
     except ValueError:
         raise HTTPException(status_code=400, detail="La IP del cliente no es válida")
     user_id = str(uuid4())
-    users[user_id] = {"username": user.username, "ip": client_ip}
+    await astate.add_user(user_id, {"username": user.username, "ip": client_ip})
     logging.info(f"User registered: user_id={user_id}, username={user.username}, ip={client_ip}")
     return {"user_id": user_id, "username": user.username, "ip": client_ip}
 
 # Ruta: Crear una sala
 class CreateRoomRequest(BaseModel):
     user_id: str
+    job: bool = False  # Si es True se responde al momento con un job_id (202)
 
 @app.post("/create-room")
 async def create_room(create_request: CreateRoomRequest):
     user_id = create_request.user_id
-    if user_id not in users:
+    if await astate.get_user(user_id) is None:
         raise HTTPException(status_code=404, detail="Usuario no registrado")
-    
+    if VPN_MODE != "multiplexed":
+        # Sin parámetros DH en el pool habrá que generarlos aquí
+        work_classes = ["dh"] if DH_POOL_SIZE <= 0 or dh_pool.depth() == 0 else []
+        check_admission(user_id, *work_classes, *([] if LAZY_SERVER_START else ["spawn"]))
+
     room_id = str(uuid4())
-    rooms[room_id] = {
-        "host_id": user_id,
-        "participants": [user_id],
-        "process": None
-    }
-    
+    await astate.add_room(room_id, user_id)
+
+    if create_request.job:
+        job = await create_job("create-room", build_room(room_id, user_id))
+        return job_accepted(job, room_id=room_id)
+    return await build_room(room_id, user_id)
+
+
+async def build_room(room_id: str, user_id: str):
     try:
-        create_virtual_network(room_id)
+        await create_virtual_network(room_id, user_id)
+        rooms_created_total.inc()
+        event_bus.publish("room_created", room_id, user_id=user_id, participants=len(await astate.participants(room_id)))
         logging.info(f"Room created: room_id={room_id}, host={user_id}")
-        return {"room_id": room_id, "host": users[user_id], "participants": rooms[room_id]["participants"]}
+        return {"room_id": room_id, "host": await astate.get_user(user_id), "participants": await astate.participants(room_id)}
+    except HTTPException:
+        # Rechazada por el control de admisión: la sala no llega a existir
+        await discard_room(room_id)
+        raise
+    except AllocationError as e:
+        failures_total.inc(operation="create_room")
+        logging.error(f"Error creating room {room_id}: {e}")
+        await discard_room(room_id)
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
-       logging.error(f"Error creating room {room_id}: {e}")
-       raise HTTPException(status_code=500, detail=f"Error al crear la red virtual: {str(e)}")
+        failures_total.inc(operation="create_room")
+        logging.error(f"Error creating room {room_id}: {e}")
+        await discard_room(room_id)
+        raise HTTPException(status_code=500, detail=f"Error al crear la red virtual: {str(e)}")
+
+
+# Deshace una sala que no llegó a crearse: estado, puerto y subred, parámetros DH y directorio
+async def discard_room(room_id: str):
+    room = await astate.delete_room(room_id)
+    if room is not None:
+        await run_blocking(release_room_network, room)
+    config_dir = os.path.join(OPEN_VPN_DIR, room_id)
+    if DH_POOL_SIZE > 0:
+        await run_blocking(dh_pool.put_back, os.path.join(config_dir, "dh.pem"))
+    await run_blocking(shutil.rmtree, config_dir, ignore_errors=True)
+
+
+# Prepara demoCA (clave del CA, index.txt y serial) y copia ca.crt a OPEN_VPN_DIR
+def prepare_ca_dir():
+    # Crea la carpeta demoCA si no existe y copia la clave del CA
+    os.makedirs(os.path.join(OPEN_VPN_DIR,"demoCA/private"), exist_ok=True)
+    shutil.copy(CA_KEY_FILE, os.path.join(OPEN_VPN_DIR,"demoCA/private/ca.key"))
+    # Crea el archivo index.txt y serial si no existen
+    if not os.path.exists(os.path.join(OPEN_VPN_DIR, "demoCA/index.txt")):
+        write_file(os.path.join(OPEN_VPN_DIR, "demoCA/index.txt"), "")
+    if not os.path.exists(os.path.join(OPEN_VPN_DIR, "demoCA/serial")):
+        write_file(os.path.join(OPEN_VPN_DIR, "demoCA/serial"), "01")
+    # Copia el certificado ca.crt a /tmp/openvpn_rooms/
+    shutil.copy(CA_CERT_FILE, os.path.join(OPEN_VPN_DIR, "ca.crt"))
+
+
+# Toma dh.pem del pool; solo si está vacío lo generamos aquí (como subproceso asyncio)
+async def provide_dh_params(dh_file: str, user_id: Optional[str] = None):
+    with stage_duration.time(stage="dhparam"):
+        if not await run_blocking(dh_pool.take, dh_file):
+            logging.warning(f"DH pool empty, generating parameters for {dh_file}")
+            async with admission["dh"].slot(user_id):
+                await run_command(*dh_params_command(dh_file))
 
 
 # Función para crear una red virtual usando OpenVPN
-def create_virtual_network(room_id: str):
+async def create_virtual_network(room_id: str, user_id: Optional[str] = None):
+    if VPN_MODE == "multiplexed":
+        await add_room_to_mux(room_id)
+        return
     try:
-        os.makedirs(OPEN_VPN_DIR, exist_ok=True)
         config_dir = os.path.join(OPEN_VPN_DIR, room_id)
-        os.makedirs(config_dir, exist_ok=True)
+        await run_blocking(os.makedirs, config_dir, exist_ok=True)
 
         config_file = os.path.join(config_dir, "server.conf")
 
+        # Puerto y subred propios para que las salas puedan convivir en el mismo host.
+        # Se reservan antes que los parámetros DH: si no quedan, no se gasta ninguno.
+        network = await run_blocking(allocate_room_network, room_id)
+        await astate.update_room(room_id, **network)
+        subnet = ipaddress.ip_network(network["subnet"])
+
         dh_file = os.path.join(config_dir, "dh.pem")
-        subprocess.run([
-            "openssl",
-            "dhparam",
-            "-out",
-            dh_file,
-            "2048"
-        ], check = True)
-
-        # Crea la carpeta demoCA si no existe y copia la clave del CA
-        os.makedirs(os.path.join(OPEN_VPN_DIR,"demoCA/private"), exist_ok=True)
-        subprocess.run([
-          "cp",
-          "ca.key",
-          os.path.join(OPEN_VPN_DIR,"demoCA/private/ca.key")
-          ], check = True)
-       # Crea el archivo index.txt y serial si no existen
-        if not os.path.exists(os.path.join(OPEN_VPN_DIR, "demoCA/index.txt")):
-            with open(os.path.join(OPEN_VPN_DIR, "demoCA/index.txt"), 'w') as f:
-                f.write("")
-        if not os.path.exists(os.path.join(OPEN_VPN_DIR, "demoCA/serial")):
-            with open(os.path.join(OPEN_VPN_DIR, "demoCA/serial"), 'w') as f:
-                f.write("01")
-
-        # Copia el certificado ca.crt a /tmp/openvpn_rooms/
-        subprocess.run([
-          "cp",
-          "ca.crt",
-          os.path.join(OPEN_VPN_DIR, "ca.crt")
-        ], check = True)
-
-
-
-        server_template = template_env.get_template("server.conf.j2")
-        rendered_config = server_template.render(dh_file=dh_file, config_dir=config_dir)
-        with open(config_file, "w") as f:
-            f.write(rendered_config)
+        await provide_dh_params(dh_file, user_id)
+
+        with stage_duration.time(stage="template_render"):
+            server_template = get_template("server.conf.j2")
+            rendered_config = server_template.render(
+                dh_file=dh_file,
+                config_dir=config_dir,
+                port=network["port"],
+                proto=network["proto"],
+                network=str(subnet.network_address),
+                netmask=str(subnet.netmask),
+            )
+            await run_blocking(write_file, config_file, rendered_config)
         
-        # Iniciar OpenVPN en modo daemon
-        process = subprocess.Popen(["openvpn", "--config", config_file],
-                                    cwd=config_dir, 
-                                   stdout=subprocess.PIPE, 
-                                   stderr=subprocess.PIPE, 
-                                   text=True)
-        rooms[room_id]["process"] = process
+        # Con LAZY_SERVER_START el openvpn no arranca hasta que entra el primer invitado
+        if not LAZY_SERVER_START:
+            await start_room_server(room_id, user_id)
     
+    except (HTTPException, AllocationError):
+        raise
     except Exception as e:
         logging.error(f"Error creating virtual network {room_id}: {e}")
         raise Exception(f"Error al crear la red virtual: {e}")
 
+room_start_locks = {}
+
+
+# Inicia (si no está ya en marcha) el OpenVPN de una sala bajo el supervisor,
+# con interfaz de gestión para leer sus clientes
+async def start_room_server(room_id: str, user_id: Optional[str] = None):
+    # El lock evita arranques dobles en este worker; entre workers decide claim_process
+    lock = room_start_locks.setdefault(room_id, asyncio.Lock())
+    async with lock:
+        health = supervisor.health(room_id)
+        if health is not None and health["state"] in ("starting", "running", "restarting"):
+            return
+        record = await astate.get_process(room_id)
+        if record is not None and process_alive(record["pid"]):
+            return  # Lo supervisa otro worker
+        room = await astate.get_room(room_id)
+        if room is None:
+            raise HTTPException(status_code=404, detail="Sala no encontrada")
+        config_dir = os.path.join(OPEN_VPN_DIR, room_id)
+        config_file = os.path.join(config_dir, "server.conf")
+        async with admission["spawn"].slot(user_id):
+            if not await astate.claim_process(room_id, room["port"], time.time() - RECONCILE_GRACE):
+                return  # Otro worker lo está arrancando o ya lo supervisa
+            with stage_duration.time(stage="openvpn_spawn"):
+                await supervisor.start(
+                    room_id,
+                    ["openvpn", "--config", config_file, "--management", management_socket_path(room_id), "unix"],
+                    cwd=config_dir,
+                    port=room["port"],
+                    claimed=True,
+                )
+    event_bus.publish("server_started", room_id)
+    logging.info(f"openvpn for room {room_id} started")
+
+
+async def room_server_running(room_id: str) -> bool:
+    health = supervisor.health(room_id)
+    if health is not None:
+        return health["state"] in ("starting", "running", "restarting")
+    record = await astate.get_process(room_id)
+    return record is not None and process_alive(record["pid"])
+
+
+class ManagementError(Exception):
+    pass
+
+
+# Un lock por socket: la interfaz de gestión de OpenVPN atiende una conexión a la vez
+management_locks = {}
+
+
+# Envía un comando a la interfaz de gestión de un servidor OpenVPN y devuelve las líneas de respuesta
+async def management_command(socket_path: str, command: str, timeout: float = 5.0) -> List[str]:
+    lock = management_locks.setdefault(socket_path, asyncio.Lock())
+    async with lock:
+        reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(socket_path), timeout)
+        try:
+            writer.write(f"{command}\n".encode())
+            await writer.drain()
+            lines = []
+            while True:
+                raw = await asyncio.wait_for(reader.readline(), timeout)
+                if not raw:
+                    break
+                line = raw.decode(errors="replace").rstrip("\r\n")
+                if line.startswith(">"):
+                    # Saludo y notificaciones en tiempo real
+                    continue
+                if line.startswith("ERROR:"):
+                    raise ManagementError(line)
+                if line.startswith("SUCCESS:"):
+                    lines.append(line)
+                    break
+                if line == "END":
+                    break
+                lines.append(line)
+            writer.write(b"quit\n")
+            await writer.drain()
+            return lines
+        finally:
+            writer.close()
+
+
+# Servidores OpenVPN compartidos por todas las salas en modo multiplexado
+mux_servers = []
+
+
+# Socket de gestión de un servidor: por sala o compartido (mux-N)
+def management_socket_path(key: str) -> str:
+    return os.path.join(OPEN_VPN_DIR, key, "management.sock")
+
+
+async def firewall(*args):
+    if not MUX_FIREWALL:
+        return
+    try:
+        await run_command("iptables", *args)
+    except Exception as e:
+        logging.error(f"Error applying firewall rule {args}: {e}")
+
+
+# Cadena VPN_ROOMS: solo se permite tráfico entre clientes de la misma sala
+async def setup_room_firewall():
+    if not MUX_FIREWALL:
+        return
+    try:
+        await run_command("iptables", "-N", "VPN_ROOMS")
+    except Exception:
+        pass  # La cadena ya existe
+    await firewall("-F", "VPN_ROOMS")
+    await firewall("-A", "VPN_ROOMS", "-s", MUX_NETWORK, "-d", MUX_NETWORK, "-j", "DROP")
+    # Las salas que siguen en el estado (p. ej. tras reiniciar el host) recuperan su regla
+    for room in await astate.all_rooms():
+        if room.get("subnet"):
+            await firewall("-I", "VPN_ROOMS", "1", "-s", room["subnet"], "-d", room["subnet"], "-j", "ACCEPT")
+    try:
+        await run_command("iptables", "-C", "FORWARD", "-j", "VPN_ROOMS")
+    except Exception:
+        await firewall("-I", "FORWARD", "1", "-j", "VPN_ROOMS")
+
+
+async def start_mux_server(index: int, network: ipaddress.IPv4Network):
+    config_dir = os.path.join(OPEN_VPN_DIR, f"mux-{index}")
+    ccd_dir = os.path.join(config_dir, "ccd")
+    await run_blocking(os.makedirs, ccd_dir, exist_ok=True)
+    dh_file = os.path.join(config_dir, "dh.pem")
+    if not await run_blocking(os.path.exists, dh_file):
+        await provide_dh_params(dh_file)
+    server = {
+        "index": index,
+        "port": MUX_BASE_PORT + index,
+        "proto": MUX_PROTO,
+        "network": network,
+        "config_dir": config_dir,
+        "ccd_dir": ccd_dir,
+        "management_socket": management_socket_path(f"mux-{index}"),
+        # La primera subred queda reservada para la dirección del propio servidor
+        "subnets": BitmapAllocator(f"mux-{index}/subnet", 2 ** (ROOM_SUBNET_PREFIX - MUX_SERVER_PREFIX) - 1),
+        "rooms": set(),
+        "process": None,
+    }
+    key = f"mux-{index}"
+    for room in await astate.all_rooms():
+        if room.get("server") == index:
+            server["rooms"].add(room["room_id"])
+    # Si otro worker o una ejecución anterior ya lo tiene en marcha, lo adoptamos
+    process = await run_blocking(get_room_process, key)
+    if process is not None:
+        server["process"] = process
+        logging.info(f"Multiplexed OpenVPN server {index} adopted (pid {process.pid})")
+        return server
+    config_file = os.path.join(config_dir, "server.conf")
+    server_template = get_template("mux_server.conf.j2")
+    rendered_config = server_template.render(
+        port=server["port"],
+        proto=server["proto"],
+        network=str(network.network_address),
+        netmask=str(network.netmask),
+        ca_file=os.path.join(OPEN_VPN_DIR, "ca.crt"),
+        server_cert=os.path.abspath(SERVER_CERT_FILE),
+        server_key=os.path.abspath(SERVER_KEY_FILE),
+        dh_file=dh_file,
+        ccd_dir=ccd_dir,
+        management_socket=server["management_socket"],
+        config_dir=config_dir,
+    )
+    await run_blocking(write_file, config_file, rendered_config)
+    server["process"] = await supervisor.start(key, ["openvpn", "--config", config_file], cwd=config_dir, port=server["port"])
+    logging.info(f"Multiplexed OpenVPN server {index} started on port {server['port']} ({network})")
+    return server
+
+
+async def start_mux_servers():
+    if VPN_MODE != "multiplexed":
+        return
+    lock_file = await run_blocking(acquire_state_lock)
+    try:
+        # Como en modo por sala, los servidores compartidos siguen vivos al parar el worker y se
+        # re-adoptan aquí sin cortar sesiones; la cadena solo se rehace si no queda ninguno
+        processes = await astate.list_processes()
+        if not any(key.startswith("mux-") for key in processes):
+            await setup_room_firewall()
+        networks = ipaddress.ip_network(MUX_NETWORK).subnets(new_prefix=MUX_SERVER_PREFIX)
+        for index, network in zip(range(MUX_SERVERS), networks):
+            mux_servers.append(await start_mux_server(index, network))
+    finally:
+        lock_file.close()
+
+
+# Da de alta una sala en el servidor compartido con menos salas: solo reserva subred y regla
+async def add_room_to_mux(room_id: str):
+    for server in sorted(mux_servers, key=lambda candidate: len(candidate["rooms"])):
+        try:
+            subnet_index = await run_blocking(server["subnets"].allocate, room_id)
+        except AllocationError:
+            continue
+        break
+    else:
+        raise AllocationError("No quedan subredes libres en los servidores multiplexados")
+    subnet = nth_subnet(server["network"], ROOM_SUBNET_PREFIX, subnet_index + 1)
+    server["rooms"].add(room_id)
+    await astate.update_room(room_id, server=server["index"], subnet=str(subnet), subnet_index=subnet_index, port=server["port"], proto=server["proto"])
+    await firewall("-I", "VPN_ROOMS", "1", "-s", str(subnet), "-d", str(subnet), "-j", "ACCEPT")
+
+
+# Direcciones de clientes de una sala multiplexada (reservadas en el estado, como puertos y subredes)
+def room_hosts(room: dict) -> BitmapAllocator:
+    subnet = ipaddress.ip_network(room["subnet"])
+    return BitmapAllocator(f"hosts/{room['room_id']}", subnet.num_addresses - 2)
+
+
+# CN del certificado de cliente. En modo multiplexado un usuario puede estar en varias salas
+# del mismo servidor, así que cada pertenencia lleva su propio CN (entrada ccd y sesión).
+# Son los dos UUID sin guiones: 64 caracteres, el máximo que admite un CN.
+def client_common_name(room_id: str, user_id: str) -> str:
+    if VPN_MODE != "multiplexed":
+        return user_id
+    return uuid.UUID(room_id).hex + uuid.UUID(user_id).hex
+
+
+# Asigna al cliente una IP de la subred de su sala mediante su entrada en client-config-dir
+async def add_client_to_mux(room_id: str, user_id: str) -> dict:
+    room = await astate.get_room(room_id)
+    server = mux_servers[room["server"]]
+    subnet = ipaddress.ip_network(room["subnet"])
+    try:
+        host_index = await run_blocking(room_hosts(room).allocate, user_id)
+    except AllocationError:
+        raise Exception("La sala no tiene direcciones libres")
+    address = subnet.network_address + 1 + host_index
+    await run_blocking(
+        write_file,
+        os.path.join(server["ccd_dir"], client_common_name(room_id, user_id)),
+        f"ifconfig-push {address} {server['network'].netmask}\n",
+    )
+    return server
+
+
+# Desconecta al cliente del servidor compartido y borra su entrada en client-config-dir;
+# solo la de esta sala, sus sesiones en otras salas del mismo servidor siguen
+async def remove_client_from_mux(room: dict, user_id: str):
+    server = mux_servers[room["server"]]
+    kind = f"hosts/{room['room_id']}"
+    for value, owner in (await astate.claims(kind)).items():
+        if owner == user_id:
+            await astate.release(kind, value)
+    common_name = client_common_name(room["room_id"], user_id)
+    ccd_file = os.path.join(server["ccd_dir"], common_name)
+    if await run_blocking(os.path.exists, ccd_file):
+        await run_blocking(os.remove, ccd_file)
+    try:
+        await management_command(server["management_socket"], f"kill {common_name}")
+    except (ManagementError, OSError, asyncio.TimeoutError):
+        pass  # El cliente no estaba conectado
+
+
+async def remove_room_from_mux(room_id: str, room: dict):
+    server = mux_servers[room["server"]]
+    for user_id in set((await astate.claims(f"hosts/{room_id}")).values()):
+        await remove_client_from_mux(room, user_id)
+    await astate.release_kind(f"hosts/{room_id}")
+    await firewall("-D", "VPN_ROOMS", "-s", room["subnet"], "-d", room["subnet"], "-j", "ACCEPT")
+    server["rooms"].discard(room_id)
+    await run_blocking(server["subnets"].release, room["subnet_index"])
+
+
 # Ruta: Unirse a una sala
 class JoinRoomRequest(BaseModel):
     room_id: str
     user_id: str
+    job: bool = False  # Si es True se responde al momento con un job_id (202)
+    download: Optional[str] = None  # "ovpn" o "gzip": responde con el fichero .ovpn en vez de JSON
 
 @app.post("/join-room")
 async def join_room(request: JoinRoomRequest):
     room_id = request.room_id
     user_id = request.user_id
-    if room_id not in rooms:
+    if await astate.get_room(room_id) is None:
         raise HTTPException(status_code=404, detail="Sala no encontrada")
-    if user_id not in users:
+    if await astate.get_user(user_id) is None:
         raise HTTPException(status_code=404, detail="Usuario no registrado")
+    if request.download not in (None, "ovpn", "gzip"):
+        raise HTTPException(status_code=400, detail="download debe ser 'ovpn' o 'gzip'")
+    check_admission(user_id, "crypto", *(["spawn"] if VPN_MODE != "multiplexed" and not await room_server_running(room_id) else []))
 
-    # Verificar si el usuario ya está en la sala
-    if user_id in rooms[room_id]["participants"]:
+    # Verificar si el usuario ya está en la sala (la inserción es atómica entre workers)
+    if not await astate.add_participant(room_id, user_id):
         raise HTTPException(status_code=409, detail="Ya estás en esta sala")
-    
-    rooms[room_id]["participants"].append(user_id)
+
+    if request.job:
+        job = await create_job("join-room", build_client_access(room_id, user_id))
+        return job_accepted(job, room_id=room_id)
+    result = await build_client_access(room_id, user_id)
+    if request.download:
+        return client_config_download(result, room_id, user_id, request.download)
+    return result
+
+
+async def build_client_access(room_id: str, user_id: str):
     # Llamar a OpenVPN para conectar al usuario a la red virtual
     try:
         config = await get_client_config(room_id, user_id)
+        joins_total.inc()
+        await astate.update_room(room_id, last_activity=time.time())
+        event_bus.publish("participant_joined", room_id, user_id=user_id, participants=len(await astate.participants(room_id)))
         logging.info(f"User {user_id} joined room {room_id}")
-        return {"room_id": room_id, "participants": rooms[room_id]["participants"], "ovpn_config": config["ovpn_config"]}
+        return {"room_id": room_id, "participants": await astate.participants(room_id), "ovpn_config": config["ovpn_config"]}
+    except HTTPException:
+        # Rechazada por el control de admisión: el usuario no llega a entrar en la sala
+        await astate.remove_participant(room_id, user_id)
+        raise
     except Exception as e:
+        failures_total.inc(operation="join_room")
         logging.error(f"Error connecting user {user_id} to room {room_id}: {e}")
         raise HTTPException(status_code=500, detail=f"Error al conectar a la red virtual: {str(e)}")
 
 
+# Guarda el certificado y la clave del cliente en su directorio
+def store_client_certs(user_config_dir: str, user_id: str, certs: dict):
+    os.makedirs(user_config_dir, exist_ok=True)
+    write_file(os.path.join(user_config_dir, f"{user_id}-cert.crt"), certs["cert_content"])
+    key_file = os.path.join(user_config_dir, f"{user_id}-key.key")
+    with open(os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+        f.write(certs["key_content"])
+
+
 #  Genera los certificados para un usuario dado.
-def generate_client_certs(room_id, user_id):
+async def generate_client_certs(room_id, user_id):
     user_config_dir = os.path.join(OPEN_VPN_DIR, room_id, user_id)
-    os.makedirs(user_config_dir, exist_ok=True)
+    common_name = client_common_name(room_id, user_id)
+    # Con el CA cargado en memoria se firma en proceso, sin CSR ni openssl
+    if certificate_authority.ready:
+        certs = await run_blocking(certificate_authority.issue, common_name)
+        await run_blocking(store_client_certs, user_config_dir, user_id, certs)
+        return certs
+
+    await run_blocking(os.makedirs, user_config_dir, exist_ok=True)
     cert_file = os.path.join(user_config_dir, f"{user_id}-cert.crt")
     key_file = os.path.join(user_config_dir, f"{user_id}-key.key")
     #  Obtenemos la ruta del ca.crt
     ca_path = os.path.join(OPEN_VPN_DIR,"ca.crt")
     ca_key_path = os.path.join(OPEN_VPN_DIR,"demoCA/private/ca.key")
     newcerts_path = os.path.join(OPEN_VPN_DIR,"demoCA/newcerts")
+    csr_file = os.path.join(user_config_dir, f"{user_id}.csr")
     try:
         # Ejecutar comandos OpenSSL para generar certificado y clave del cliente
-        subprocess.run(
-            [
-                "openssl",
-                "req",
-                "-new",
-                "-newkey",
-                "rsa:2048",
-                "-nodes",
-                "-keyout",
-                key_file,
-                "-out",
-                f"{user_id}.csr", #  Se genera un .csr, pero lo borramos justo despues
-                "-subj",
-                f"/CN={user_id}/C=US/ST=ExampleState/O=ExampleOrg",
-            ],
+        start = time.perf_counter()
+        await run_command(
+            "openssl",
+            "req",
+            "-new",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-keyout",
+            key_file,
+            "-out",
+            f"{user_id}.csr", #  Se genera un .csr, pero lo borramos justo despues
+            "-subj",
+            f"/CN={common_name}/C=US/ST=ExampleState/O=ExampleOrg",
             cwd = user_config_dir,
-            check=True,
         )
-        subprocess.run(
-            [
-                "openssl",
-                "ca",
-                "-config",
-                 "/usr/lib/ssl/openssl.cnf",
-                "-keyfile",
-                ca_key_path,
-                "-cert",
-                ca_path,
-                "-in",
-                f"{user_id}.csr",
-                "-out",
-                cert_file,
-                "-days",
-                "3650",
-                "-batch", # para no tener que darle a "Y" todo el rato.
-                "-policy", "policy_anything",
-                "-extensions", "v3_ca",
-                 "-outdir", newcerts_path 
-            ],
+        stage_duration.observe(time.perf_counter() - start, stage="key_generation")
+        start = time.perf_counter()
+        await run_command(
+            "openssl",
+            "ca",
+            "-config",
+             "/usr/lib/ssl/openssl.cnf",
+            "-keyfile",
+            ca_key_path,
+            "-cert",
+            ca_path,
+            "-in",
+            f"{user_id}.csr",
+            "-out",
+            cert_file,
+            "-days",
+            "3650",
+            "-batch", # para no tener que darle a "Y" todo el rato.
+            "-policy", "policy_anything",
+            "-extensions", "v3_ca",
+             "-outdir", newcerts_path,
             cwd = user_config_dir,
-            check=True,
         )
+        stage_duration.observe(time.perf_counter() - start, stage="ca_signing")
     except subprocess.CalledProcessError as e:
-        logging.error(f"Error al generar certificados: {e}")
+        logging.error(f"Error al generar certificados: {e} {e.stderr!r}")
         raise Exception(f"Error al generar certificados: {e}")
     finally:
         #  Borrar el csr porque no nos hace falta.
-        csr_file = os.path.join(user_config_dir, f"{user_id}.csr")
         if os.path.exists(csr_file):
-            os.remove(csr_file)
+            await run_blocking(os.remove, csr_file)
     
-    with open(cert_file, 'r') as f:
-        cert_content = f.read()
-    with open(key_file, 'r') as f:
-        key_content = f.read()
+    cert_content = await run_blocking(read_file, cert_file)
+    key_content = await run_blocking(read_file, key_file)
     return {"cert_content":cert_content, "key_content":key_content}
 
-# Función para obtener la configuración del cliente OpenVPN
+
+class ClientConfigTemplate:
+    """client.ovpn.j2 con los bloques estáticos (IP del servidor, CA, tls-auth) ya renderizados.
+
+    Se renderiza una vez con marcadores en lugar de los valores de cada cliente y se trocea
+    por ellos, así que montar una configuración es concatenar cadenas en memoria. Si la
+    plantilla usa esos valores para algo más que sustituirlos (condiciones, filtros), las
+    pruebas del constructor no cuadran y se renderiza entera en cada llamada.
+    """
+
+    DYNAMIC = ("cert_content", "key_content", "port", "proto")
+    SAMPLES = (
+        {"cert_content": "-----CERT-----\n", "key_content": "-----KEY-----\n", "port": 1194, "proto": "udp"},
+        {"cert_content": "c", "key_content": "k", "port": 443, "proto": "tcp"},
+    )
+
+    def __init__(self, template: jinja2.Template, **static):
+        self.template = template
+        self.static = static
+        markers = {name: f"\x00{name}\x00" for name in self.DYNAMIC}
+        self.parts = re.split("\x00(" + "|".join(self.DYNAMIC) + ")\x00", template.render(**static, **markers))
+        if any(self._assemble(sample) != template.render(**static, **sample) for sample in self.SAMPLES):
+            logging.warning("client.ovpn.j2 depends on per-client values beyond substitution, rendering it on every join")
+            self.parts = None
+
+    def _assemble(self, values: dict) -> str:
+        return "".join(part if index % 2 == 0 else str(values[part]) for index, part in enumerate(self.parts))
+
+    def render(self, **values) -> str:
+        if self.parts is not None and set(values) == set(self.DYNAMIC):
+            return self._assemble(values)
+        return self.template.render(**self.static, **values)
+
+
+client_config_template = None
+
+
+# Bloques comunes a todas las configuraciones de cliente
+def client_static_blocks() -> dict:
+    blocks = {"server_ip": SERVER_IP, "ca_content": None, "tls_auth_content": None}
+    for name, path in (("ca_content", CA_CERT_FILE), ("tls_auth_content", TLS_AUTH_FILE)):
+        if os.path.exists(path):
+            blocks[name] = read_file(path)
+    return blocks
+
+
+def get_client_config_template() -> ClientConfigTemplate:
+    global client_config_template
+    if client_config_template is None:
+        client_config_template = ClientConfigTemplate(get_template("client.ovpn.j2"), **client_static_blocks())
+    return client_config_template
+
+
+# Función para obtener la configuración del cliente OpenVPN (se monta en memoria)
 async def get_client_config(room_id: str, user_id: str):
-    user_config_dir = os.path.join(OPEN_VPN_DIR, room_id, user_id)
-    os.makedirs(user_config_dir, exist_ok=True)
-    config_file = os.path.join(user_config_dir, "client.ovpn")
-    certs = generate_client_certs(room_id, user_id)
+    async with admission["crypto"].slot(user_id):
+        certs = await generate_client_certs(room_id, user_id)
+    if VPN_MODE == "multiplexed":
+        await add_client_to_mux(room_id, user_id)
+    else:
+        await start_room_server(room_id, user_id)
+    # El cliente debe conectarse al puerto que se asignó al servidor de su sala
+    room = await astate.get_room(room_id) or {}
+    server_options = {key: room[key] for key in ("port", "proto") if key in room}
     
-    client_template = template_env.get_template("client.ovpn.j2")
-    rendered_config = client_template.render(
-        cert_content = certs["cert_content"], 
-        key_content = certs["key_content"],
-        server_ip=SERVER_IP
+    with stage_duration.time(stage="config_assembly"):
+        config_content = get_client_config_template().render(
+            cert_content=certs["cert_content"],
+            key_content=certs["key_content"],
+            **server_options
         )
-    with open(config_file, "w") as f:
-        f.write(rendered_config)
-    
-    with open(config_file, 'r') as f:
-            config_content = f.read()
-    
-    #Eliminar el archivo del servidor
-    if os.path.exists(config_file):
-         os.remove(config_file)
 
     return {"ovpn_config": config_content}
 
-# Ruta: Consultar salas activas
+
+# Devuelve la configuración como fichero .ovpn descargable, opcionalmente comprimido con gzip
+def client_config_download(result: dict, room_id: str, user_id: str, download: str) -> Response:
+    filename = f"{room_id}-{user_id}.ovpn"
+    content = result["ovpn_config"].encode()
+    media_type = "application/x-openvpn-profile"
+    if download == "gzip":
+        content = gzip.compress(content)
+        filename += ".gz"
+        media_type = "application/gzip"
+    return Response(content=content, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+# Instantánea de los listados de salas: se reconstruye sólo cuando cambia la versión de
+# salas/participantes del estado, y guarda las páginas y detalles ya serializados.
+class RoomSnapshot:
+    def __init__(self, version: str, rooms: List[dict]):
+        self.version = version
+        self.etag = f'"rooms-{version}"'
+        # bisect sobre keys necesita el mismo orden (created_at, room_id) que los cursores
+        self.rooms = sorted(rooms, key=lambda room: (room["created_at"], room["room_id"]))
+        self.keys = [(room["created_at"], room["room_id"]) for room in self.rooms]
+        self.ids = {room["room_id"] for room in self.rooms}
+        self.pages = {}
+        self.details = {}
+
+
+room_snapshot = None
+
+
+async def current_room_snapshot() -> RoomSnapshot:
+    global room_snapshot
+    version = await astate.rooms_version()
+    if room_snapshot is None or room_snapshot.version != version:
+        room_snapshot = RoomSnapshot(version, await astate.list_rooms())
+    return room_snapshot
+
+
+def encode_room_cursor(room: dict) -> str:
+    raw = json.dumps([room["created_at"], room["room_id"]]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_room_cursor(cursor: str) -> tuple:
+    try:
+        created_at, room_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return float(created_at), str(room_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Cursor no válido")
+
+
+def room_page(snapshot: RoomSnapshot, cursor: Optional[str], limit: Optional[int], host: Optional[str], min_participants: int):
+    start = bisect.bisect_right(snapshot.keys, decode_room_cursor(cursor)) if cursor else 0
+    page = []
+    next_cursor = None
+    for room in snapshot.rooms[start:]:
+        if host is not None and room["host_id"] != host:
+            continue
+        if room["participants"] < min_participants:
+            continue
+        if limit is not None and len(page) == limit:
+            # Queda al menos una sala más: la página siguiente empieza tras la última devuelta
+            next_cursor = encode_room_cursor(page[-1])
+            break
+        page.append(room)
+    return page, next_cursor
+
+
+def not_modified(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in (tag.strip().removeprefix("W/") for tag in header.split(","))
+
+
+# Ruta: Consultar salas activas (con limit se pagina; la siguiente página va en X-Next-Cursor)
 @app.get("/rooms")
-async def get_rooms():
-    return [{"room_id": room_id, "participants": len(data["participants"])} for room_id, data in rooms.items()]
+async def get_rooms(
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = None,
+    host: Optional[str] = None,
+    min_participants: int = 0,
+):
+    if limit is not None and not 1 <= limit <= 1000:
+        raise HTTPException(status_code=400, detail="limit debe estar entre 1 y 1000")
+    snapshot = await current_room_snapshot()
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if not_modified(request, snapshot.etag):
+        return Response(status_code=304, headers=headers)
+    key = (cursor, limit, host, min_participants)
+    cached = snapshot.pages.get(key)
+    if cached is None:
+        page, next_cursor = room_page(snapshot, cursor, limit, host, min_participants)
+        cached = (json.dumps(page).encode(), next_cursor)
+        # Cada combinación de filtros se serializa una vez por versión (con tope por si varían mucho)
+        if len(snapshot.pages) < 256:
+            snapshot.pages[key] = cached
+    body, next_cursor = cached
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+        headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 # Ruta: Consultar participantes de una sala
 @app.get("/rooms/{room_id}")
-async def get_room_details(room_id: str):
-    if room_id not in rooms:
+async def get_room_details(room_id: str, request: Request):
+    snapshot = await current_room_snapshot()
+    if room_id not in snapshot.ids:
+        raise HTTPException(status_code=404, detail="Sala no encontrada")
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if not_modified(request, snapshot.etag):
+        return Response(status_code=304, headers=headers)
+    body = snapshot.details.get(room_id)
+    if body is None:
+        body = snapshot.details[room_id] = json.dumps({"participants": [await astate.get_user(uid) for uid in await astate.participants(room_id)]}).encode()
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+# Eventos de salas (alta, entrada y salida de participantes, cierre) publicados en proceso:
+# cada worker reparte los que genera él mismo a sus suscriptores WebSocket/SSE.
+events_published_total = Counter("vpn_events_published_total", "Eventos de salas publicados", ("type",))
+event_resyncs_total = Counter("vpn_event_resyncs_total", "Suscriptores que perdieron eventos y deben releer el estado")
+
+
+class EventSubscription:
+    """Cola acotada de un suscriptor. Si se llena (consumidor lento) se vacía y se le
+    pide que relea el estado (resync) en lugar de frenar a quien publica."""
+
+    def __init__(self, bus, room_id: Optional[str]):
+        self.bus = bus
+        self.room_id = room_id
+        self.pending = deque()
+        self.lagged = False
+        self._wakeup = asyncio.Event()
+
+    def push(self, event: dict):
+        if self.lagged:
+            return
+        if len(self.pending) >= EVENT_QUEUE_SIZE:
+            self.pending.clear()
+            self.lagged = True
+            event_resyncs_total.inc()
+        else:
+            self.pending.append(event)
+        self._wakeup.set()
+
+    async def next_batch(self) -> dict:
+        while not self.pending and not self.lagged:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        # Espera un poco para agrupar las ráfagas en un solo mensaje
+        await asyncio.sleep(EVENT_COALESCE_WINDOW)
+        if self.lagged:
+            self.lagged = False
+            self.pending.clear()
+            return {"type": "resync", "token": self.bus.token()}
+        events = list(self.pending)
+        self.pending.clear()
+        return {"type": "events", "events": coalesce_events(events), "token": self.bus.token(events[-1]["seq"])}
+
+
+# Deja sólo el último evento de cada participante en el lote y, si la sala se cerró,
+# sólo su cierre; el orden (seq) se mantiene
+def coalesce_events(events: List[dict]) -> List[dict]:
+    deleted = {event["room_id"] for event in events if event["type"] == "room_deleted"}
+    latest = {}
+    for event in events:
+        if event["room_id"] in deleted and event["type"] != "room_deleted":
+            continue
+        latest[(event["room_id"], event.get("user_id"), event["type"] == "room_deleted")] = event
+    return sorted(latest.values(), key=lambda event: event["seq"])
+
+
+class EventBus:
+    """Pub/sub en proceso con un historial circular para reanudar desde un token."""
+
+    def __init__(self, history_size: int):
+        self.epoch = uuid4().hex[:8]
+        self.seq = 0
+        self.history = deque(maxlen=history_size)
+        self.room_subscribers = {}
+        self.global_subscribers = set()
+
+    def token(self, seq: Optional[int] = None) -> str:
+        return f"{self.epoch}-{self.seq if seq is None else seq}"
+
+    def publish(self, event_type: str, room_id: str, **data):
+        self.seq += 1
+        event = {"seq": self.seq, "type": event_type, "room_id": room_id, "time": time.time(), **data}
+        self.history.append(event)
+        events_published_total.inc(type=event_type)
+        for subscription in self.room_subscribers.get(room_id, ()):
+            subscription.push(event)
+        for subscription in self.global_subscribers:
+            subscription.push(event)
+
+    def subscribe(self, room_id: Optional[str] = None, token: Optional[str] = None) -> EventSubscription:
+        subscription = EventSubscription(self, room_id)
+        if token:
+            self._replay(subscription, token)
+        if room_id is None:
+            self.global_subscribers.add(subscription)
+        else:
+            self.room_subscribers.setdefault(room_id, set()).add(subscription)
+        return subscription
+
+    def _replay(self, subscription: EventSubscription, token: str):
+        epoch, _, seq = token.rpartition("-")
+        try:
+            seq = int(seq)
+        except ValueError:
+            seq = -1
+        oldest = self.history[0]["seq"] if self.history else self.seq + 1
+        if epoch != self.epoch or seq < oldest - 1 or seq > self.seq:
+            # Token de otro proceso o demasiado antiguo: no sabemos qué se perdió
+            subscription.lagged = True
+            event_resyncs_total.inc()
+            return
+        for event in self.history:
+            if event["seq"] > seq and (subscription.room_id is None or event["room_id"] == subscription.room_id):
+                subscription.push(event)
+
+    def unsubscribe(self, subscription: EventSubscription):
+        if subscription.room_id is None:
+            self.global_subscribers.discard(subscription)
+            return
+        subscribers = self.room_subscribers.get(subscription.room_id)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.room_subscribers[subscription.room_id]
+
+    def subscriber_count(self) -> int:
+        return len(self.global_subscribers) + sum(len(subscribers) for subscribers in self.room_subscribers.values())
+
+
+event_bus = EventBus(EVENT_HISTORY_SIZE)
+
+
+async def stream_events_websocket(websocket: WebSocket, room_id: Optional[str]):
+    await websocket.accept()
+    subscription = event_bus.subscribe(room_id, websocket.query_params.get("token"))
+    # Leemos del socket sólo para enterarnos de que el cliente se ha ido
+    receiver = asyncio.create_task(websocket.receive_text())
+    try:
+        while True:
+            batch = asyncio.create_task(subscription.next_batch())
+            await asyncio.wait({batch, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if batch.done():
+                await websocket.send_json(batch.result())
+            else:
+                # Cancelar antes de entregar no pierde nada: los eventos siguen en la cola
+                batch.cancel()
+            if receiver.done():
+                if receiver.exception() is not None:
+                    break
+                # Los mensajes del cliente se ignoran
+                receiver = asyncio.create_task(websocket.receive_text())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        event_bus.unsubscribe(subscription)
+
+
+def stream_events_sse(request: Request, room_id: Optional[str]) -> StreamingResponse:
+    token = request.headers.get("last-event-id") or request.query_params.get("token")
+    subscription = event_bus.subscribe(room_id, token)
+
+    async def body():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    batch = await asyncio.wait_for(subscription.next_batch(), timeout=EVENT_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {batch['token']}\nevent: {batch['type']}\ndata: {json.dumps(batch)}\n\n"
+        finally:
+            event_bus.unsubscribe(subscription)
+
+    return StreamingResponse(body(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# Ruta: Eventos de una sala por WebSocket (?token= para reanudar)
+@app.websocket("/rooms/{room_id}/events")
+async def room_events_websocket(websocket: WebSocket, room_id: str):
+    if await astate.get_room(room_id) is None and not websocket.query_params.get("token"):
+        await websocket.close(code=4404)
+        return
+    await stream_events_websocket(websocket, room_id)
+
+
+# Ruta: Eventos de una sala por SSE (reanuda con Last-Event-ID)
+@app.get("/rooms/{room_id}/events")
+async def room_events_sse(room_id: str, request: Request):
+    if await astate.get_room(room_id) is None and not (request.headers.get("last-event-id") or request.query_params.get("token")):
         raise HTTPException(status_code=404, detail="Sala no encontrada")
-    return {"participants": [users[uid] for uid in rooms[room_id]["participants"]]}
+    return stream_events_sse(request, room_id)
+
+
+# Ruta: Eventos de todas las salas por WebSocket
+@app.websocket("/events")
+async def events_websocket(websocket: WebSocket):
+    await stream_events_websocket(websocket, None)
+
+
+# Ruta: Eventos de todas las salas por SSE
+@app.get("/events")
+async def events_sse(request: Request):
+    return stream_events_sse(request, None)
 
 
 # Ruta: Salir de una sala
@@ -298,71 +2856,524 @@ class LeaveRoomRequest(BaseModel):
 async def leave_room(request: LeaveRoomRequest):
     room_id = request.room_id
     user_id = request.user_id
-    if room_id not in rooms:
+    if await astate.get_room(room_id) is None:
         raise HTTPException(status_code=404, detail="Sala no encontrada")
-    if user_id not in users:
+    if await astate.get_user(user_id) is None:
         raise HTTPException(status_code=404, detail="Usuario no registrado")
-    if user_id not in rooms[room_id]["participants"]:
+    # Eliminar al usuario de la sala
+    if not await astate.remove_participant(room_id, user_id):
         raise HTTPException(status_code=409, detail="El usuario no está en esta sala")
     
-    rooms[room_id]["participants"].remove(user_id)  # Eliminar al usuario de la sala
+    room = await astate.get_room(room_id)
+    if room is None:
+        # Otro worker ya eliminó la sala
+        return {"room_id": room_id, "participants": []}
+    if "server" in room:
+        await remove_client_from_mux(room, user_id)
     
     # Si la sala se queda sin participantes, podemos eliminar la sala
-    if not rooms[room_id]["participants"]:
-        process = rooms[room_id]["process"]
-        if process and process.poll() is None:  # Verify the subprocess is still running
-            process.terminate()  # Terminate gracefully
-            process.wait(timeout=10) # Wait for it to finish
-            if process.poll() is None: # Check that the subprocess was effectively terminated
-                logging.error(f"Error terminating openvpn process for room {room_id}")
-                # You could use process.kill() if it doesnt terminate after 10 secs
-        del rooms[room_id]
+    if not room["participants"]:
+        await astate.delete_room(room_id)
+        leaves_total.inc()
+        event_bus.publish("participant_left", room_id, user_id=user_id, participants=0)
+        await teardown_room(room)
         logging.info(f"Room {room_id} removed")
         return {"room_id": room_id, "participants": []}
+    leaves_total.inc()
+    await astate.update_room(room_id, last_activity=time.time())
+    event_bus.publish("participant_left", room_id, user_id=user_id, participants=len(room["participants"]))
     logging.info(f"User {user_id} left room {room_id}")
-    return {"room_id": room_id, "participants": rooms[room_id]["participants"]}
+    return {"room_id": room_id, "participants": room["participants"]}
+
+
+# Cierra una sala ya borrada del estado: servidor compartido, eventos y proceso openvpn.
+# Su directorio lo retira después la limpieza incremental.
+async def teardown_room(room: dict):
+    room_id = room["room_id"]
+    if "server" in room:
+        await remove_room_from_mux(room_id, room)
+    room_start_locks.pop(room_id, None)
+    management_locks.pop(management_socket_path(room_id), None)
+    event_bus.publish("room_deleted", room_id)
+    # La parada (terminate y, si no responde, kill) sigue en segundo plano; el puerto
+    # y la subred se liberan cuando el proceso ha terminado
+    schedule_room_release(room, supervisor.stop(room_id))
+
+
+room_releases = set()
+
+
+def schedule_room_release(room: dict, stop_task):
+    async def release():
+        if stop_task is not None:
+            await asyncio.gather(stop_task, return_exceptions=True)
+        await run_blocking(release_room_network, room)
+
+    task = asyncio.create_task(release())
+    room_releases.add(task)
+    task.add_done_callback(room_releases.discard)
+
+
+# Ruta: Arrancar el servidor de una sala parada por inactividad (para sus participantes)
+class ActivateRoomRequest(BaseModel):
+    user_id: str
+
+@app.post("/rooms/{room_id}/activate")
+async def activate_room(room_id: str, request: ActivateRoomRequest):
+    room = await astate.get_room(room_id)
+    if room is None:
+        raise HTTPException(status_code=404, detail="Sala no encontrada")
+    if request.user_id not in room["participants"]:
+        raise HTTPException(status_code=403, detail="El usuario no está en esta sala")
+    if "server" not in room and not await room_server_running(room_id):
+        check_admission(request.user_id, "spawn")
+        try:
+            await start_room_server(room_id, request.user_id)
+        except HTTPException:
+            raise
+        except Exception as e:
+            failures_total.inc(operation="activate_room")
+            logging.error(f"Error activating room {room_id}: {e}")
+            raise HTTPException(status_code=500, detail=f"Error al arrancar la red virtual: {str(e)}")
+    await astate.update_room(room_id, last_activity=time.time())
+    return {"room_id": room_id, "port": room.get("port"), "proto": room.get("proto"), "running": True}
+
+
+reaped_total = Counter("vpn_reaped_total", "Servidores parados y salas expiradas por inactividad", ("kind",))
+gc_removed_total = Counter("vpn_gc_removed_total", "Directorios retirados por la limpieza incremental", ("kind",))
+
+
+# Lock no bloqueante entre workers para las tareas periódicas: solo uno las hace en cada pasada.
+# Devuelve el fichero (el lock se suelta al cerrarlo) o None si lo tiene otro worker.
+def try_maintenance_lock(name: str):
+    os.makedirs(OPEN_VPN_DIR, exist_ok=True)
+    lock_file = open(os.path.join(OPEN_VPN_DIR, f".{name}.lock"), "a+")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+# Clientes conectados a la sala según la interfaz de gestión; None si no se puede saber
+def connected_clients(room: dict, servers: Dict[str, List[dict]], running: bool) -> Optional[int]:
+    if "server" in room:
+        clients = servers.get(f"mux-{room['server']}")
+        if clients is None:
+            return None
+        common_names = {client_common_name(room["room_id"], user_id) for user_id in room["participants"]}
+        return sum(1 for client in clients if client["common_name"] in common_names)
+    if not running:
+        return 0
+    clients = servers.get(room["room_id"])
+    return len(clients) if clients is not None else None
+
+
+# Una pasada del reaper: para los servidores sin clientes durante SERVER_IDLE_TIMEOUT y
+# expira las salas sin conexiones ni cambios durante ROOM_IDLE_TIMEOUT
+async def reap_idle_rooms():
+    servers = await management_scraper.all_clients()
+    now = time.time()
+    for room in await astate.all_rooms():
+        room_id = room["room_id"]
+        record = await astate.get_process(room_id) if "server" not in room else None
+        running = "server" not in room and await room_server_running(room_id)
+        connected = connected_clients(room, servers, running)
+        if connected is None:
+            continue  # Servidor arrancando o sin interfaz de gestión: no sabemos si está en uso
+        if connected:
+            await astate.update_room(room_id, last_connected=now)
+            continue
+        quiet_since = max(room["created_at"], room.get("last_activity", 0), room.get("last_connected", 0))
+        if running and record is not None:
+            quiet_since = max(quiet_since, record["started_at"])
+        idle = now - quiet_since
+        if ROOM_IDLE_TIMEOUT > 0 and idle >= ROOM_IDLE_TIMEOUT:
+            if await astate.delete_room(room_id) is None:
+                continue
+            await teardown_room(room)
+            reaped_total.inc(kind="room")
+            logging.info(f"Room {room_id} expired after {idle:.0f}s idle")
+        elif running and SERVER_IDLE_TIMEOUT > 0 and idle >= SERVER_IDLE_TIMEOUT:
+            supervisor.stop(room_id)
+            reaped_total.inc(kind="server")
+            event_bus.publish("server_stopped", room_id)
+            logging.info(f"openvpn for room {room_id} stopped after {idle:.0f}s without clients")
+
+
+class DirectoryGC:
+    """Retira poco a poco los directorios de salas que ya no existen y los de usuarios
+    que ya no están en su sala (con sus claves privadas).
+
+    Recorre OPEN_VPN_DIR con un iterador que se conserva entre pasos y cada paso examina
+    como mucho `batch_size` entradas, así que nunca genera picos de E/S. Solo borra lo que
+    lleva más de `grace` segundos sin modificarse, para no pisar una sala en creación.
+    """
+
+    def __init__(self, root: str, batch_size: int, grace: float):
+        self.root = root
+        self.batch_size = batch_size
+        self.grace = grace
+        self._walker = None
+        self.passes = 0
+        self.removed = 0
+
+    def _walk(self):
+        if not os.path.isdir(self.root):
+            return
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not is_room_id(entry.name) or not entry.is_dir(follow_symlinks=False):
+                    continue
+                room = state.get_room(entry.name)
+                if room is None:
+                    yield entry.path, "room_dir"
+                    continue
+                yield None
+                participants = set(room["participants"])
+                try:
+                    with os.scandir(entry.path) as user_entries:
+                        for user_entry in user_entries:
+                            if (
+                                is_room_id(user_entry.name)
+                                and user_entry.name not in participants
+                                and user_entry.is_dir(follow_symlinks=False)
+                            ):
+                                yield user_entry.path, "user_dir"
+                            else:
+                                yield None
+                except FileNotFoundError:
+                    continue
+
+    def _stale(self, path: str) -> bool:
+        try:
+            return os.stat(path).st_mtime < time.time() - self.grace
+        except FileNotFoundError:
+            return False
+
+    def step(self) -> int:
+        removed = 0
+        if self._walker is None:
+            self._walker = self._walk()
+        for _ in range(self.batch_size):
+            try:
+                item = next(self._walker)
+            except StopIteration:
+                self._walker = None
+                self.passes += 1
+                break
+            if item is None:
+                continue
+            path, kind = item
+            if not self._stale(path):
+                continue
+            # La sala puede haberse creado con ese id entre tanto; se comprueba de nuevo
+            if kind == "room_dir" and state.get_room(os.path.basename(path)) is not None:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            gc_removed_total.inc(kind=kind)
+            removed += 1
+        self.removed += removed
+        return removed
+
+
+directory_gc = DirectoryGC(OPEN_VPN_DIR, GC_BATCH_SIZE, GC_GRACE)
+
+
+async def run_reaper():
+    while True:
+        await asyncio.sleep(REAPER_INTERVAL)
+        lock_file = await run_blocking(try_maintenance_lock, "reaper")
+        if lock_file is None:
+            continue
+        try:
+            await reap_idle_rooms()
+        except Exception as e:
+            logging.error(f"Error reaping idle rooms: {e}")
+        finally:
+            lock_file.close()
+
+
+async def run_directory_gc():
+    while True:
+        await asyncio.sleep(GC_INTERVAL)
+        lock_file = await run_blocking(try_maintenance_lock, "gc")
+        if lock_file is None:
+            continue
+        try:
+            removed = await run_blocking(directory_gc.step)
+            if removed:
+                logging.info(f"Directory GC removed {removed} stale directories")
+        except Exception as e:
+            logging.error(f"Error collecting stale directories: {e}")
+        finally:
+            lock_file.close()
+
+
+async def start_maintenance_tasks():
+    if SERVER_IDLE_TIMEOUT > 0 or ROOM_IDLE_TIMEOUT > 0:
+        background_tasks.add(asyncio.create_task(run_reaper()))
+    if GC_BATCH_SIZE > 0:
+        background_tasks.add(asyncio.create_task(run_directory_gc()))
+
+
+# Ruta: Estado del proceso openvpn de una sala
+@app.get("/rooms/{room_id}/health")
+async def get_room_health(room_id: str):
+    room = await astate.get_room(room_id)
+    if room is None:
+        raise HTTPException(status_code=404, detail="Sala no encontrada")
+    # En modo multiplexado la sala vive en un servidor compartido
+    key = f"mux-{room['server']}" if "server" in room else room_id
+    health = supervisor.health(key)
+    if health is None:
+        record = await astate.get_process(key)
+        alive = record is not None and process_alive(record["pid"])
+        health = {
+            "state": "running" if alive else "starting" if record is not None and not record["pid"] else "stopped",
+            "pid": record["pid"] if record else None,
+            "uptime_seconds": round(time.time() - record["started_at"], 1) if alive else 0,
+            "supervised_by": record["owner"] if record else None,
+        }
+    return {"room_id": room_id, "process": key, **health}
+
+
+# Convierte la salida de `status 2` en una lista de clientes usando las cabeceras HEADER,CLIENT_LIST
+def parse_client_list(lines: List[str]) -> List[dict]:
+    columns = None
+    clients = []
+    for line in lines:
+        fields = line.split(",")
+        if fields[:2] == ["HEADER", "CLIENT_LIST"]:
+            columns = fields[2:]
+        elif fields[0] == "CLIENT_LIST" and columns:
+            row = dict(zip(columns, fields[1:]))
+            clients.append({
+                "common_name": row.get("Common Name", ""),
+                "real_address": row.get("Real Address", ""),
+                "virtual_address": row.get("Virtual Address", ""),
+                "bytes_received": int(row.get("Bytes Received") or 0),
+                "bytes_sent": int(row.get("Bytes Sent") or 0),
+                "connected_since": int(row.get("Connected Since (time_t)") or 0),
+            })
+    return clients
+
+
+class ManagementScraper:
+    """Lista de clientes conectados a cada servidor, leída de su interfaz de gestión.
+
+    Cada lectura se cachea MANAGEMENT_SCRAPE_TTL segundos, así que los scrapes de
+    /metrics (y cualquier otro consumidor) no generan carga extra sobre openvpn.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._cache = {}
+
+    async def clients(self, key: str) -> Optional[List[dict]]:
+        cached = self._cache.get(key)
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            return cached[1]
+        try:
+            clients = parse_client_list(await management_command(management_socket_path(key), "status 2"))
+        except (ManagementError, OSError, asyncio.TimeoutError):
+            clients = None  # Sin interfaz de gestión (arrancando, caído o sin socket)
+        self._cache[key] = (time.monotonic(), clients)
+        return clients
+
+    async def all_clients(self) -> Dict[str, List[dict]]:
+        keys = [key for key in await astate.list_processes() if key != "test-vpn"]
+        for key in set(self._cache) - set(keys):
+            del self._cache[key]
+        results = await asyncio.gather(*(self.clients(key) for key in keys))
+        return {key: clients for key, clients in zip(keys, results) if clients is not None}
+
+
+management_scraper = ManagementScraper(MANAGEMENT_SCRAPE_TTL)
+
+
+# Ruta: Métricas en formato Prometheus
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    room_list = await astate.list_rooms()
+    processes = await astate.list_processes()
+    lines.extend(render_gauge("vpn_rooms", "Salas activas", [({}, len(room_list))]))
+    lines.extend(render_gauge("vpn_participants", "Participantes en todas las salas", [({}, sum(room["participants"] for room in room_list))]))
+    lines.extend(render_gauge(
+        "vpn_openvpn_processes", "Procesos openvpn en ejecución",
+        [({}, sum(1 for entry in processes.values() if process_alive(entry["pid"])))],
+    ))
+    lines.extend(render_gauge("vpn_dh_pool_depth", "Parámetros DH disponibles en el pool", [({}, dh_pool.depth())]))
+    lines.extend(render_gauge("vpn_event_subscribers", "Suscriptores a flujos de eventos", [({}, event_bus.subscriber_count())]))
+    lines.extend(render_gauge("vpn_key_pool_depth", "Claves de cliente disponibles en el pool", [({}, certificate_authority.stats()["key_pool_depth"])]))
+    for name, field, help_text in (
+        ("vpn_admission_active", "active", "Trabajos en curso por clase de trabajo"),
+        ("vpn_admission_queue_depth", "queued", "Peticiones en la cola de admisión por clase de trabajo"),
+    ):
+        lines.extend(render_gauge(name, help_text, [({"work_class": key}, getattr(queue, field)) for key, queue in admission.items()]))
+    servers = await management_scraper.all_clients()
+    lines.extend(render_gauge(
+        "vpn_connected_sessions", "Sesiones conectadas por servidor openvpn",
+        [({"server": key}, len(clients)) for key, clients in servers.items()],
+    ))
+    for name, field, help_text in (
+        ("vpn_client_bytes_received", "bytes_received", "Bytes recibidos de cada cliente en la sesión actual"),
+        ("vpn_client_bytes_sent", "bytes_sent", "Bytes enviados a cada cliente en la sesión actual"),
+    ):
+        lines.extend(render_gauge(name, help_text, [
+            ({"server": key, "client": client["common_name"]}, client[field])
+            for key, clients in servers.items() for client in clients
+        ]))
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
     
     
 @app.get("/test-vpn")
 async def test_vpn():
     try:
-        test_virtual_network()
+        await test_virtual_network()
         return {"message": "OpenVPN iniciado para pruebas."}
     except Exception as e:
         return {"error": f"Error al iniciar la red virtual de prueba: {str(e)}"}
 
 
-def test_virtual_network():
+async def test_virtual_network():
     try:
-        os.makedirs(OPEN_VPN_DIR, exist_ok=True)
         config_dir = os.path.join(OPEN_VPN_DIR, "test-vpn")
-        os.makedirs(config_dir, exist_ok=True)
+        await run_blocking(os.makedirs, config_dir, exist_ok=True)
 
         config_file = os.path.join(config_dir, "server.conf")
 
         dh_file = os.path.join(config_dir, "dh.pem")
-        subprocess.run([
-            "openssl",
-            "dhparam",
-            "-out",
-            dh_file,
-            "2048"
-        ], check = True)
+        await provide_dh_params(dh_file)
 
-        server_template = template_env.get_template("test_server.conf.j2")
+        server_template = get_template("test_server.conf.j2")
         rendered_config = server_template.render(dh_file=dh_file, config_dir=config_dir)
-        with open(config_file, "w") as f:
-            f.write(rendered_config)
+        await run_blocking(write_file, config_file, rendered_config)
         
-        # Iniciar OpenVPN en modo daemon
-        process = subprocess.Popen(["openvpn", "--config", config_file, "--log",  os.path.join(config_dir,"server.log")],
-                                    stdout=subprocess.PIPE, 
-                                   stderr=subprocess.PIPE, 
-                                   text=True)
-        rooms["test-vpn"] = {
-            "process": process
-        }
+        # Iniciar OpenVPN bajo el supervisor
+        if supervisor.get("test-vpn") is not None:
+            await supervisor.stop("test-vpn")
+        await supervisor.start(
+            "test-vpn",
+            ["openvpn", "--config", config_file, "--log", os.path.join(config_dir,"server.log")],
+            cwd=config_dir,
+        )
     
     except Exception as e:
         logging.error(f"Error creating test virtual network: {e}")
-        raise Exception(f"Error al crear la red virtual de prueba: {e}")
\ No newline at end of file
+        raise Exception(f"Error al crear la red virtual de prueba: {e}")
+
+
+# Arranque: resuelve la IP anunciada, prepara el CA y compila las plantillas una sola vez
+readiness = {"bootstrapped": False, "warm": False, "shutting_down": False, "errors": {}}
+
+
+def resolve_server_ip() -> str:
+    return socket.gethostbyname(socket.gethostname())
+
+
+# IP de la interfaz de salida, sin DNS (connect en UDP no envía nada)
+def outbound_ip() -> str:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        try:
+            s.connect(("192.0.2.1", 9))
+            return s.getsockname()[0]
+        except OSError:
+            return "127.0.0.1"
+
+
+async def resolve_advertised_ip():
+    global SERVER_IP
+    if SERVER_IP:
+        return
+    try:
+        SERVER_IP = await asyncio.wait_for(run_blocking(resolve_server_ip), timeout=SERVER_IP_RESOLVE_TIMEOUT)
+    except (OSError, asyncio.TimeoutError) as e:
+        SERVER_IP = outbound_ip()
+        logging.warning(f"Could not resolve hostname ({e!r}), advertising {SERVER_IP}; set SERVER_IP to override")
+    logging.info(f"Advertised server IP: {SERVER_IP}")
+
+
+def precompile_templates():
+    for name in template_loader.list_templates():
+        if name.endswith(".j2"):
+            get_template(name)
+    required = ["client.ovpn.j2", "mux_server.conf.j2" if VPN_MODE == "multiplexed" else "server.conf.j2"]
+    missing = [name for name in required if name not in compiled_templates]
+    if missing:
+        raise Exception(f"Faltan plantillas: {', '.join(missing)}")
+    get_client_config_template()
+    logging.info(f"Templates compiled: {', '.join(sorted(compiled_templates))}")
+
+
+async def bootstrap_step(name: str, step):
+    try:
+        result = step()
+        if asyncio.iscoroutine(result):
+            await result
+    except Exception as e:
+        readiness["errors"][name] = str(e)
+        logging.error(f"Bootstrap step {name} failed: {e}")
+
+
+async def bootstrap():
+    start = time.perf_counter()
+    await start_event_loop_monitor()
+    await resolve_advertised_ip()
+    await start_state_reconciliation()
+    # El directorio del CA (demoCA, ca.crt) se prepara aquí y no en cada sala
+    await bootstrap_step("ca", lambda: run_blocking(prepare_ca_dir))
+    start_dh_pool()
+    await bootstrap_step("ca_signing", lambda: run_blocking(start_certificate_authority))
+    await bootstrap_step("templates", lambda: run_blocking(precompile_templates))
+    await start_mux_servers()
+    await start_maintenance_tasks()
+    readiness["bootstrapped"] = True
+    logging.info(f"Bootstrap finished in {time.perf_counter() - start:.2f}s")
+
+
+async def shutdown():
+    readiness["shutting_down"] = True
+    await stop_background_tasks()
+    await stop_supervisor()
+    if room_releases:
+        await asyncio.gather(*room_releases, return_exceptions=True)
+    stop_dh_pool()
+    stop_certificate_authority()
+
+
+# Pools calientes: parámetros DH (solo per-room) y claves de cliente. Una vez
+# calientes no se vuelve a mirar, para no sacar al worker del balanceador bajo carga.
+def warm_pools() -> dict:
+    checks = {}
+    if VPN_MODE != "multiplexed" and DH_POOL_SIZE > 0:
+        checks["dh_pool"] = dh_pool.available() >= min(READY_DH_POOL_MIN, DH_POOL_SIZE)
+    if certificate_authority.ready and CLIENT_KEY_POOL_SIZE > 0:
+        checks["key_pool"] = certificate_authority.stats()["key_pool_depth"] >= min(READY_KEY_POOL_MIN, CLIENT_KEY_POOL_SIZE)
+    return checks
+
+
+# Ruta: Preparado para recibir tráfico (503 hasta terminar el arranque y calentar los pools)
+@app.get("/ready")
+async def get_ready():
+    pools = {}
+    if readiness["bootstrapped"] and not readiness["warm"]:
+        pools = await run_blocking(warm_pools)
+        readiness["warm"] = all(pools.values())
+    ready = readiness["bootstrapped"] and readiness["warm"] and not readiness["errors"] and not readiness["shutting_down"]
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "ready": ready,
+            "bootstrapped": readiness["bootstrapped"],
+            "warm": readiness["warm"],
+            "pools": pools,
+            "shutting_down": readiness["shutting_down"],
+            "errors": readiness["errors"],
+            "server_ip": SERVER_IP,
+        },
+    )
\ No newline at end of file
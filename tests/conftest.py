@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# main lee la configuración del entorno al importarse: estado en memoria y un directorio temporal
+os.environ.setdefault("STATE_BACKEND", "memory")
+os.environ.setdefault("OPEN_VPN_DIR", tempfile.mkdtemp(prefix="openvpn_rooms_test_"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
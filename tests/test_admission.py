@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from main import WorkQueue
+
+
+async def hold(queue: WorkQueue, user_id: str, release: asyncio.Event, order: list = None):
+    async with queue.slot(user_id):
+        if order is not None:
+            order.append(user_id)
+        await release.wait()
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_full_queue_is_rejected_with_retry_after():
+    async def scenario():
+        queue = WorkQueue("test", limit=1, queue_size=1, user_queue_size=5)
+        release = asyncio.Event()
+        active = asyncio.create_task(hold(queue, "a", release))
+        waiting = asyncio.create_task(hold(queue, "b", release))
+        await settle()
+        assert (queue.active, queue.queued) == (1, 1)
+        with pytest.raises(HTTPException) as excinfo:
+            async with queue.slot("c"):
+                pass
+        release.set()
+        await asyncio.gather(active, waiting)
+        return queue, excinfo.value
+
+    queue, error = asyncio.run(scenario())
+    assert error.status_code == 429
+    assert int(error.headers["Retry-After"]) >= 1
+    assert queue.rejected == 1
+    assert (queue.active, queue.queued) == (0, 0)
+
+
+def test_retry_after_follows_service_time():
+    queue = WorkQueue("test", limit=2, queue_size=8, user_queue_size=8)
+    queue.service_time = 3.0
+    queue.active, queue.queued = 2, 4
+    # Seis trabajos por delante repartidos entre dos huecos de 3 s
+    assert queue.retry_after() == 9
+
+
+def test_per_user_queue_cap():
+    async def scenario():
+        queue = WorkQueue("test", limit=1, queue_size=10, user_queue_size=1)
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold(queue, "a", release)), asyncio.create_task(hold(queue, "b", release))]
+        await settle()
+        with pytest.raises(HTTPException) as excinfo:
+            async with queue.slot("b"):
+                pass
+        # Otro usuario todavía cabe en la cola
+        tasks.append(asyncio.create_task(hold(queue, "c", release)))
+        await settle()
+        queued = queue.queued
+        release.set()
+        await asyncio.gather(*tasks)
+        return excinfo.value, queued
+
+    error, queued = asyncio.run(scenario())
+    assert error.status_code == 429
+    assert queued == 2
+
+
+def test_cancelled_waiter_hands_its_slot_on():
+    async def scenario():
+        queue = WorkQueue("test", limit=1, queue_size=10, user_queue_size=10)
+        rest = asyncio.Event()
+        order = []
+        holder = queue.slot("a")
+        await holder.__aenter__()
+        granted = asyncio.create_task(hold(queue, "b", rest, order))
+        next_waiter = asyncio.create_task(hold(queue, "c", rest, order))
+        await settle()
+        # Al soltar el hueco se cede a "b", que se cancela antes de llegar a usarlo
+        await holder.__aexit__(None, None, None)
+        assert queue._waiters.get("b") is None
+        granted.cancel()
+        await settle()
+        state = (queue.active, queue.queued, list(order))
+        rest.set()
+        await asyncio.wait_for(next_waiter, 1)
+        with pytest.raises(asyncio.CancelledError):
+            await granted
+        return queue, state
+
+    queue, (active, queued, order) = asyncio.run(scenario())
+    assert order == ["c"]
+    assert (active, queued) == (1, 0)
+    assert (queue.active, queue.queued) == (0, 0)
+
+
+def test_cancelled_queued_waiter_leaves_the_queue():
+    async def scenario():
+        queue = WorkQueue("test", limit=1, queue_size=10, user_queue_size=10)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(queue, "a", release))
+        waiter = asyncio.create_task(hold(queue, "b", release))
+        await settle()
+        waiter.cancel()
+        await settle()
+        counts = (queue.active, queue.queued, len(queue._waiters))
+        release.set()
+        await holder
+        return queue, counts
+
+    queue, counts = asyncio.run(scenario())
+    assert counts == (1, 0, 0)
+    assert (queue.active, queue.queued) == (0, 0)
+
+
+def test_waiters_are_served_round_robin_between_users():
+    async def scenario():
+        queue = WorkQueue("test", limit=1, queue_size=10, user_queue_size=10)
+        release = asyncio.Event()
+        order = []
+        tasks = [asyncio.create_task(hold(queue, "first", release, order))]
+        await settle()
+        for user_id in ("a", "a", "a", "b", "b", "c"):
+            tasks.append(asyncio.create_task(hold(queue, user_id, release, order)))
+            await settle()
+        release.set()
+        await asyncio.gather(*tasks)
+        return order
+
+    # Un usuario con varias peticiones en cola no adelanta a los demás
+    assert asyncio.run(scenario()) == ["first", "a", "b", "c", "a", "b", "a"]
@@ -0,0 +1,65 @@
+from uuid import uuid4
+
+import pytest
+
+import main
+from main import AllocationError, BitmapAllocator, nth_subnet
+
+
+def allocator(size: int) -> BitmapAllocator:
+    # Cada prueba usa su propio tipo de recurso en el estado compartido
+    return BitmapAllocator(f"test/{uuid4().hex}", size)
+
+
+def test_allocates_every_index_once_then_fails():
+    pool = allocator(8)
+    values = [pool.allocate(f"owner-{index}") for index in range(8)]
+    assert sorted(values) == list(range(8))
+    with pytest.raises(AllocationError):
+        pool.allocate("late")
+
+
+def test_claims_are_recorded_in_the_state_store():
+    pool = allocator(4)
+    value = pool.allocate("room-a")
+    assert main.state.claims(pool.kind) == {value: "room-a"}
+    pool.release(value)
+    assert main.state.claims(pool.kind) == {}
+
+
+def test_released_index_is_reused():
+    pool = allocator(2)
+    first = pool.allocate("a")
+    pool.allocate("b")
+    pool.release(first)
+    assert pool.allocate("c") == first
+
+
+def test_skips_indexes_claimed_by_another_worker():
+    pool = allocator(3)
+    main.state.claim(pool.kind, 0, "other-worker")
+    assert {pool.allocate("a"), pool.allocate("b")} == {1, 2}
+    with pytest.raises(AllocationError):
+        pool.allocate("c")
+
+
+def test_sees_indexes_released_by_another_worker():
+    pool = allocator(2)
+    pool.allocate("a")
+    other = pool.allocate("b")
+    # Otro worker libera su reserva directamente en el estado compartido
+    main.state.release(pool.kind, other)
+    assert pool.allocate("c") == other
+
+
+def test_stats_count_claims_from_the_state_store():
+    pool = allocator(4)
+    pool.allocate("a")
+    main.state.claim(pool.kind, 3, "other-worker")
+    assert pool.stats() == {"size": 4, "used": 2, "free": 2}
+
+
+def test_nth_subnet():
+    network = main.ipaddress.ip_network("10.8.0.0/16")
+    assert str(nth_subnet(network, 24, 0)) == "10.8.0.0/24"
+    assert str(nth_subnet(network, 24, 255)) == "10.8.255.0/24"
@@ -0,0 +1,72 @@
+import os
+import time
+from uuid import uuid4
+
+import pytest
+
+import main
+from main import DirectoryGC, MemoryStateStore
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = MemoryStateStore()
+    monkeypatch.setattr(main, "state", store)
+    return store
+
+
+def make_dir(*parts, age: float = 3600) -> str:
+    path = os.path.join(*parts)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "client.key"), "w") as f:
+        f.write("secret")
+    then = time.time() - age
+    os.utime(path, (then, then))
+    return path
+
+
+def test_removes_dirs_of_missing_rooms_and_departed_users(tmp_path, store):
+    room_id, host, guest, departed = (str(uuid4()) for _ in range(4))
+    store.add_room(room_id, host)
+    store.add_participant(room_id, guest)
+    kept = [make_dir(tmp_path, room_id, user_id) for user_id in (host, guest)]
+    kept.append(make_dir(tmp_path, room_id, "ccd"))
+    gone = [make_dir(tmp_path, room_id, departed), make_dir(tmp_path, str(uuid4()))]
+    gc = DirectoryGC(str(tmp_path), batch_size=100, grace=60)
+    assert gc.step() == 2
+    assert all(os.path.isdir(path) for path in kept)
+    assert not any(os.path.exists(path) for path in gone)
+    assert gc.passes == 1
+
+
+def test_keeps_anything_younger_than_grace(tmp_path, store):
+    room_id, host = str(uuid4()), str(uuid4())
+    store.add_room(room_id, host)
+    young = [make_dir(tmp_path, str(uuid4()), age=5), make_dir(tmp_path, room_id, str(uuid4()), age=5)]
+    assert DirectoryGC(str(tmp_path), batch_size=100, grace=60).step() == 0
+    assert all(os.path.isdir(path) for path in young)
+
+
+def test_never_touches_shared_directories(tmp_path, store):
+    shared = [make_dir(tmp_path, name) for name in ("demoCA", "dh_pool", "mux-0", "test-vpn")]
+    # Entradas ccd de un servidor compartido y un directorio con nombre de usuario dentro
+    shared.append(make_dir(tmp_path, "mux-0", "ccd", uuid4().hex + uuid4().hex))
+    shared.append(make_dir(tmp_path, "mux-0", str(uuid4())))
+    gc = DirectoryGC(str(tmp_path), batch_size=100, grace=0)
+    assert gc.step() == 0
+    assert all(os.path.isdir(path) for path in shared)
+
+
+def test_each_step_examines_at_most_batch_size_entries(tmp_path, store):
+    stale = [make_dir(tmp_path, str(uuid4())) for _ in range(5)]
+    lookups = []
+    get_room = store.get_room
+    store.get_room = lambda room_id: lookups.append(room_id) or get_room(room_id)
+    gc = DirectoryGC(str(tmp_path), batch_size=2, grace=60)
+    assert gc.step() == 2
+    assert sum(os.path.exists(path) for path in stale) == 3
+    # Una consulta por directorio recorrido y otra antes de borrarlo
+    assert len(lookups) == 4
+    assert (gc.step(), gc.step()) == (2, 1)
+    assert gc.passes == 1
+    assert not any(os.path.exists(path) for path in stale)
@@ -0,0 +1,81 @@
+import asyncio
+
+import main
+from main import EventBus, coalesce_events
+
+
+def event(seq: int, event_type: str, room_id: str = "r1", user_id: str = None) -> dict:
+    data = {"seq": seq, "type": event_type, "room_id": room_id}
+    if user_id is not None:
+        data["user_id"] = user_id
+    return data
+
+
+def test_coalesce_keeps_the_last_event_per_participant():
+    events = [
+        event(1, "participant_joined", user_id="a"),
+        event(2, "participant_joined", user_id="b"),
+        event(3, "participant_left", user_id="a"),
+    ]
+    assert [e["seq"] for e in coalesce_events(events)] == [2, 3]
+
+
+def test_coalesce_keeps_only_the_deletion_of_a_closed_room():
+    events = [
+        event(1, "participant_joined", user_id="a"),
+        event(2, "participant_joined", room_id="r2", user_id="a"),
+        event(3, "participant_left", user_id="a"),
+        event(4, "room_deleted"),
+    ]
+    assert [(e["seq"], e["type"]) for e in coalesce_events(events)] == [(2, "participant_joined"), (4, "room_deleted")]
+
+
+def test_coalesce_keeps_room_events_without_participant():
+    events = [event(1, "room_created", user_id="h"), event(2, "server_started"), event(3, "server_stopped")]
+    # Los eventos sin participante se agrupan por sala: sólo queda el último
+    assert [e["seq"] for e in coalesce_events(events)] == [1, 3]
+
+
+def test_resume_replays_events_after_the_token():
+    bus = EventBus(16)
+    bus.publish("room_created", "r1", user_id="h")
+    token = bus.token()
+    bus.publish("participant_joined", "r1", user_id="a")
+    bus.publish("participant_joined", "r2", user_id="b")
+    subscription = bus.subscribe("r1", token)
+    assert [e["seq"] for e in subscription.pending] == [2]
+    assert not subscription.lagged
+
+
+def test_unknown_or_expired_token_asks_for_resync():
+    bus = EventBus(2)
+    for index in range(5):
+        bus.publish("participant_joined", "r1", user_id=str(index))
+    assert bus.subscribe("r1", "other-epoch-1").lagged
+    assert bus.subscribe("r1", bus.token(1)).lagged
+    assert not bus.subscribe("r1", bus.token(3)).lagged
+
+
+def test_slow_subscriber_gets_a_resync_instead_of_blocking(monkeypatch):
+    monkeypatch.setattr(main, "EVENT_QUEUE_SIZE", 2)
+    monkeypatch.setattr(main, "EVENT_COALESCE_WINDOW", 0)
+    bus = EventBus(16)
+    subscription = bus.subscribe()
+    for index in range(3):
+        bus.publish("participant_joined", "r1", user_id=str(index))
+    batch = asyncio.run(subscription.next_batch())
+    assert batch == {"type": "resync", "token": bus.token()}
+    assert not subscription.pending
+
+
+def test_batch_token_points_at_the_last_delivered_event(monkeypatch):
+    monkeypatch.setattr(main, "EVENT_COALESCE_WINDOW", 0)
+    bus = EventBus(16)
+    subscription = bus.subscribe("r1")
+    bus.publish("participant_joined", "r1", user_id="a")
+    bus.publish("participant_left", "r1", user_id="a")
+    batch = asyncio.run(subscription.next_batch())
+    assert [e["type"] for e in batch["events"]] == ["participant_left"]
+    assert batch["token"] == bus.token(2)
+    bus.unsubscribe(subscription)
+    assert bus.subscriber_count() == 0
@@ -0,0 +1,32 @@
+from main import RoomSnapshot, encode_room_cursor, room_page
+
+
+def listing(room_id: str, created_at: float, participants: int = 1, host_id: str = "host") -> dict:
+    return {"room_id": room_id, "host_id": host_id, "created_at": created_at, "participants": participants}
+
+
+def test_snapshot_orders_ties_by_room_id():
+    # El backend en memoria devuelve las salas en orden de inserción
+    snapshot = RoomSnapshot("1", [listing("c", 2.0), listing("b", 1.0), listing("a", 1.0)])
+    assert [room["room_id"] for room in snapshot.rooms] == ["a", "b", "c"]
+
+
+def test_pages_do_not_skip_or_repeat_rooms_with_the_same_timestamp():
+    snapshot = RoomSnapshot("1", [listing(room_id, 1.0) for room_id in "edcba"])
+    seen, cursor = [], None
+    while True:
+        page, cursor = room_page(snapshot, cursor, 2, None, 0)
+        seen.extend(room["room_id"] for room in page)
+        if cursor is None:
+            break
+    assert seen == ["a", "b", "c", "d", "e"]
+
+
+def test_filters_apply_before_the_page_limit():
+    snapshot = RoomSnapshot("1", [listing("a", 1.0, 1), listing("b", 2.0, 3), listing("c", 3.0, 3, "other"), listing("d", 4.0, 2)])
+    page, cursor = room_page(snapshot, None, 1, "host", 2)
+    assert [room["room_id"] for room in page] == ["b"]
+    assert cursor == encode_room_cursor(page[0])
+    page, cursor = room_page(snapshot, cursor, 1, "host", 2)
+    assert [room["room_id"] for room in page] == ["d"]
+    assert cursor is None
@@ -0,0 +1,135 @@
+import os
+import shutil
+import time
+
+import pytest
+
+from main import MemoryStateStore, SQLiteStateStore
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStateStore()
+    return SQLiteStateStore(str(tmp_path / "state.db"))
+
+
+def test_users(store):
+    store.add_user("u1", {"username": "ana"})
+    assert store.get_user("u1") == {"username": "ana"}
+    assert store.get_user("missing") is None
+
+
+def test_rooms_and_participants(store):
+    store.add_room("r1", "host", {"port": 1194})
+    assert store.add_participant("r1", "guest")
+    assert not store.add_participant("r1", "guest")
+    room = store.get_room("r1")
+    assert room["host_id"] == "host"
+    assert room["port"] == 1194
+    assert room["participants"] == ["host", "guest"]
+    store.update_room("r1", subnet="10.8.0.0/24")
+    assert store.get_room("r1")["subnet"] == "10.8.0.0/24"
+    assert store.remove_participant("r1", "guest")
+    assert not store.remove_participant("r1", "guest")
+    assert store.participants("r1") == ["host"]
+    assert store.get_room("missing") is None
+
+
+def test_rooms_of_user_and_delete(store):
+    store.add_room("r1", "host")
+    store.add_room("r2", "other")
+    store.add_participant("r2", "host")
+    assert sorted(store.rooms_of_user("host")) == ["r1", "r2"]
+    deleted = store.delete_room("r2")
+    assert deleted["participants"] == ["other", "host"]
+    assert store.rooms_of_user("host") == ["r1"]
+    assert store.rooms_of_user("other") == []
+    assert store.delete_room("r2") is None
+
+
+def test_list_rooms_and_version(store):
+    before = store.rooms_version()
+    store.add_room("r1", "host")
+    store.add_participant("r1", "guest")
+    store.add_room("r2", "other")
+    assert store.rooms_version() != before
+    rooms = {room["room_id"]: room for room in store.list_rooms()}
+    assert {room_id: room["participants"] for room_id, room in rooms.items()} == {"r1": 2, "r2": 1}
+    assert [room["room_id"] for room in store.all_rooms()] == ["r1", "r2"]
+    # Los cambios de datos de la sala no cambian la versión del listado
+    version = store.rooms_version()
+    store.update_room("r1", port=1195)
+    assert store.rooms_version() == version
+    store.remove_participant("r1", "guest")
+    assert store.rooms_version() != version
+
+
+def test_allocations(store):
+    assert store.claim("port", 1, "r1")
+    assert not store.claim("port", 1, "r2")
+    assert store.claim("port", 2, "r2")
+    assert store.claim("subnet", 1, "r1")
+    assert store.claims("port") == {1: "r1", 2: "r2"}
+    store.release("port", 2)
+    assert store.claims("port") == {1: "r1"}
+    store.release_owner("r1")
+    assert store.claims("port") == {}
+    assert store.claims("subnet") == {}
+    store.claim("port", 3, "r3")
+    store.release_kind("port")
+    assert store.claims("port") == {}
+
+
+def test_claim_and_attach_process(store):
+    assert store.claim_process("r1", 1194, time.time() - 60)
+    # Una reserva reciente sin PID bloquea a otro worker
+    assert not store.claim_process("r1", 1194, time.time() - 60)
+    assert store.get_process("r1")["pid"] == 0
+    assert store.attach_process("r1", os.getpid())
+    assert store.get_process("r1")["pid"] == os.getpid()
+    # Con el proceso vivo tampoco se puede reservar
+    assert not store.claim_process("r1", 1194, time.time() + 60)
+    store.remove_process("r1")
+    assert store.get_process("r1") is None
+    assert not store.attach_process("r1", os.getpid())
+
+
+def test_stale_claim_is_taken_over(store):
+    assert store.claim_process("r1", 1194, time.time() - 60)
+    assert store.claim_process("r1", 1195, time.time() + 60)
+    assert store.get_process("r1")["port"] == 1195
+
+
+def test_stopping_process_cannot_be_attached(store):
+    store.claim_process("r1", 1194, time.time() - 60)
+    marked = store.mark_process_stopping("r1")
+    assert marked["stopping"]
+    assert not store.attach_process("r1", os.getpid())
+    assert store.list_processes()["r1"]["stopping"]
+    assert store.mark_process_stopping("missing") is None
+
+
+def test_jobs(store):
+    store.save_job("old", {"status": "done", "finished_at": 1.0})
+    store.save_job("running", {"status": "running"})
+    store.save_job("new", {"status": "done", "finished_at": 100.0})
+    assert store.get_job("old") == {"status": "done", "finished_at": 1.0}
+    store.prune_jobs(50.0)
+    assert store.get_job("old") is None
+    assert store.get_job("running") == {"status": "running"}
+    assert store.get_job("new")["finished_at"] == 100.0
+
+
+def test_sqlite_version_is_not_repeated_by_a_new_database(tmp_path):
+    path = str(tmp_path / "rooms" / "state.db")
+    store = SQLiteStateStore(path)
+    store.add_room("r1", "host")
+    version = store.rooms_version()
+    # Reabrir la misma base conserva la versión
+    assert SQLiteStateStore(path).rooms_version() == version
+    # Un directorio borrado (p. ej. /tmp tras reiniciar) da una base nueva con el contador a cero
+    shutil.rmtree(tmp_path / "rooms")
+    recreated = SQLiteStateStore(path)
+    recreated.add_room("r1", "host")
+    assert recreated.rooms_version() != version